@@ -0,0 +1,243 @@
+"""
+Benchmarks watchers on generated trees.
+
+Each watcher and backend is measured on trees of different sizes and
+shapes: the first walk (a constructor), an idle check, a check with
+changes, latency of change detection by a started watcher and memory.
+Results are written as JSON, so they can be compared between versions:
+
+    python benchmark.py --sizes 1000 100000 --fanouts 10 100 --depths 2 4 \
+        --output results.json
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import watchers
+from watchers import Watcher, SimpleWatcher, monotonic
+
+# Trees.
+
+def generate_tree(path, entries, fanout=10, depth=3):
+    """Creates a tree with a number of entries (files and directories) in
+    a path. Each directory has fanout subdirectories down to depth levels,
+    files are spread evenly between directories. Returns a list of files."""
+
+    dirs = [path]
+    level = [path]
+    for i in range(depth):
+        next_level = []
+        for parent in level:
+            for k in range(fanout):
+                if len(dirs) + len(next_level) > entries // 2:
+                    break
+                x = os.path.join(parent, 'dir{}'.format(k))
+                os.mkdir(x)
+                next_level.append(x)
+        dirs.extend(next_level)
+        level = next_level
+
+    files = []
+    for i in range(entries - (len(dirs) - 1)):
+        x = os.path.join(dirs[i % len(dirs)], 'file{}.txt'.format(i))
+        with open(x, 'w') as file:
+            file.write('hello world!')
+        files.append(x)
+    return files
+
+
+def modify(files, count):
+    """Modifies count files spread over a list of files."""
+
+    step = max(1, len(files) // count)
+    for path in files[::step][:count]:
+        with open(path, 'a') as file:
+            file.write('hello')
+
+
+# Watchers.
+
+def create_watcher(kind, path, backend, interval=1):
+    """Returns a recursive watcher of a kind ('Watcher' or 'SimpleWatcher')
+    and an event that is set when it reports a change."""
+
+    changed = threading.Event()
+    if kind == 'Watcher':
+        x = Watcher(interval, path, recursive=True, backend=backend)
+        x.on_created(lambda item: changed.set())
+        x.on_modified(lambda item: changed.set())
+    elif kind == 'SimpleWatcher':
+        x = SimpleWatcher(interval, path, changed.set, recursive=True,
+                          backend=backend)
+    else:
+        raise ValueError('Unknown watcher: {!r}'.format(kind))
+    return x, changed
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def measure(kind, backend, path, files, changes=10, repeat=5, interval=0.1):
+    """Returns a dict with results of one watcher on a generated tree."""
+
+    entries = sum(len(d) + len(f) for _, d, f in os.walk(path))
+    result = {'watcher': kind, 'backend': backend, 'entries': entries}
+
+    # The first walk.
+    start = monotonic()
+    x, changed = create_watcher(kind, path, backend)
+    result['cold_seconds'] = monotonic() - start
+    result['used_backend'] = x.backend
+
+    # Idle checks.
+    times = []
+    for i in range(repeat):
+        start = monotonic()
+        x.check()
+        times.append(monotonic() - start)
+    result['idle_check_seconds'] = _median(times)
+    stats = x.history[-1]
+    result['idle_stat_calls'] = stats.stat_calls
+    result['idle_cpu_seconds'] = stats.cpu_time
+
+    # Checks with changes.
+    times = []
+    for i in range(repeat):
+        modify(files, changes)
+        start = monotonic()
+        if not x.check():
+            raise RuntimeError('Changes not detected: {!r}'.format(x))
+        times.append(monotonic() - start)
+    result['changes'] = changes
+    result['change_check_seconds'] = _median(times)
+
+    # Time from a change to its event in a started watcher.
+    x, changed = create_watcher(kind, path, backend, interval)
+    x.start()
+    times = []
+    try:
+        for i in range(repeat):
+            changed.clear()
+            modify(files, 1)
+            start = monotonic()
+            if not changed.wait(max(10, 100 * interval)):
+                raise RuntimeError('Change not detected: {!r}'.format(x))
+            times.append(monotonic() - start)
+    finally:
+        x.stop()
+    result['interval'] = interval
+    result['latency_seconds'] = _median(times)
+
+    # Memory of the first walk and a check.
+    del x
+    tracemalloc.start()
+    try:
+        x, changed = create_watcher(kind, path, backend)
+        result['memory_bytes'] = tracemalloc.get_traced_memory()[0]
+        x.check()
+        result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return result
+
+
+def run(sizes=(1000, 10000, 100000, 1000000), fanouts=(10,), depths=(3,),
+        kinds=('Watcher', 'SimpleWatcher'), backends=('polling', 'inotify'),
+        changes=10, repeat=5, interval=0.1, log=None):
+    """Runs benchmarks on a tree of each size, fanout and depth. Returns
+    a dict with the environment and a list of results, see measure()."""
+
+    results = []
+    for size in sizes:
+        for fanout in fanouts:
+            for depth in depths:
+                results.extend(_run_tree(size, fanout, depth, kinds, backends,
+                                         changes, repeat, interval, log))
+
+    return {
+        'version': watchers.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'results': results
+    }
+
+
+def _run_tree(size, fanout, depth, kinds, backends, changes, repeat,
+              interval, log):
+    """Returns a list of results of watchers on one generated tree."""
+
+    results = []
+    path = tempfile.mkdtemp()
+    try:
+        files = generate_tree(path, size, fanout, depth)
+        for kind in kinds:
+            for backend in backends:
+                x = measure(kind, backend, path, files, changes, repeat,
+                            interval)
+                x.update(fanout=fanout, depth=depth)
+                results.append(x)
+                if log is not None:
+                    log(x)
+    finally:
+        shutil.rmtree(path)
+    return results
+
+
+def _print_result(x):
+    print('{watcher} ({used_backend}), {entries} entries (fanout {fanout}, '
+          'depth {depth}): first walk '
+          '{cold_seconds:.3f} s, idle check {idle_check_seconds:.4f} s, '
+          'check with {changes} changes {change_check_seconds:.4f} s, '
+          'latency {latency_seconds:.3f} s, peak memory '
+          '{peak_memory_bytes} B'.format(**x), file=sys.stderr)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmarks watchers.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000],
+                        help='numbers of entries in generated trees')
+    parser.add_argument('--fanouts', type=int, nargs='+', default=[10],
+                        help='subdirectories in each directory')
+    parser.add_argument('--depths', type=int, nargs='+', default=[3],
+                        help='levels of directories')
+    parser.add_argument('--watchers', nargs='+',
+                        default=['Watcher', 'SimpleWatcher'])
+    parser.add_argument('--backends', nargs='+',
+                        default=['polling', 'inotify'])
+    parser.add_argument('--changes', type=int, default=10,
+                        help='files modified before a check with changes')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--interval', type=float, default=0.1,
+                        help='check interval used to measure latency')
+    parser.add_argument('--output', help='JSON file, default is stdout')
+    args = parser.parse_args(argv)
+
+    x = run(args.sizes, args.fanouts, args.depths, args.watchers,
+            args.backends, args.changes, args.repeat, args.interval,
+            _print_result)
+
+    if args.output is None:
+        json.dump(x, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as file:
+            json.dump(x, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
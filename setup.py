@@ -14,9 +14,9 @@ complex libraries like great `watchdog`_.
 
 Facts or why you should take a good look at watchers.py:
 
--  No dependencies, only Python ``3.2``, ``3.3`` or ``3.4``
+-  No dependencies, only Python ``3.7`` or newer
 -  Supports **Windows** and **Unix**
--  Only one file, less than **12 KB**
+-  Only one file
 -  Simple and minimalistic
 
 Example
@@ -101,9 +101,13 @@ setup(
         'Natural Language :: English',
         'Operating System :: Microsoft :: Windows',
         'Operating System :: POSIX :: Linux',
-        'Programming Language :: Python :: 3.2',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Topic :: Software Development :: Libraries',
         'Topic :: System :: Filesystems',
         'Topic :: System :: Monitoring',
@@ -2,19 +2,25 @@
 Testing!
 """
 
+import asyncio
+import hashlib
 import os
 import os.path
 import stat
+import re
 import sys
 import unittest
 import shutil
 import tempfile
-import timeit
+import threading
+import concurrent.futures
 import time
+import urllib.request
 import platform
 
 import watchers
-from watchers import Watcher, SimpleWatcher, Manager
+from watchers import Watcher, SimpleWatcher, Manager, Scheduler, Filter, \
+    Dispatcher
 
 # For faster testing.
 CHECK_INTERVAL = 0.25
@@ -53,6 +59,46 @@ def absolute_paths(*paths):
     return [os.path.abspath(i) for i in paths]
 
 
+def count_syscalls(function):
+    """Returns numbers of stat calls and directory listings made during
+    running a function."""
+
+    stats = listings = 0
+    original_stat = os.stat
+    original_scandir = watchers.scandir
+
+    def stat(*args, **kwargs):
+        nonlocal stats
+        stats += 1
+        return original_stat(*args, **kwargs)
+
+    class Entry:
+        def __init__(self, entry):
+            self.entry = entry
+
+        def __getattr__(self, name):
+            return getattr(self.entry, name)
+
+        def stat(self):
+            nonlocal stats
+            stats += 1
+            return self.entry.stat()
+
+    def scandir(path):
+        nonlocal listings
+        listings += 1
+        return [Entry(i) for i in original_scandir(path)]
+
+    os.stat = stat
+    watchers.scandir = scandir
+    try:
+        function()
+    finally:
+        os.stat = original_stat
+        watchers.scandir = original_scandir
+    return stats, listings
+
+
 def create_test_files():
     """Returns a path to a temporary directory with example files used during
     tests."""
@@ -295,6 +341,25 @@ class BaseTest(unittest.TestCase):
         delete_dir('x', 'new_dir')
         self.assertFalse(x.check())
 
+    def test_prune(self):
+        """Should ignore everything inside a pruned directory."""
+
+        x = self.class_(CHECK_INTERVAL, recursive=True,
+                        filter=Filter(exclude='x'), **self.kwargs)
+
+        create_file('x', 'new.py')
+        self.assertFalse(x.check())
+        modify_file('x', 'y', 'foo.py')
+        self.assertFalse(x.check())
+        create_dir('x', 'new_dir')
+        self.assertFalse(x.check())
+        delete_dir('x')
+        self.assertFalse(x.check())
+
+        create_dir('x')
+        create_file('new.py')
+        self.assertTrue(x.check())
+
     def test_permissions(self):
         """Should detects a file permission changes."""
 
@@ -396,13 +461,27 @@ class BaseTest(unittest.TestCase):
     def test_delete_during_check(self):
         """Should skip files deleted by a other process during check."""
 
-        files = (self.temp_path, ['a.txt', 'b.txt'], [])
+        files = ['a.txt', 'b.txt']
+
+        class Entry:
+            def __init__(self, name):
+                self.name = name
+                self.path = os.path.join(os.getcwd(), name)
+
+            def stat(self):
+                return os.stat(self.path)
+
+            def is_dir(self):
+                return os.path.isdir(self.path)
 
-        def walk(*args, **kwargs):
-            return [files]
+            def is_symlink(self):
+                return os.path.islink(self.path)
 
-        original_walk = os.walk
-        os.walk = walk
+        def scandir(path):
+            return [Entry(i) for i in files]
+
+        original_scandir = watchers.scandir
+        watchers.scandir = scandir
 
         create_file('a.txt')
         create_file('b.txt')
@@ -412,12 +491,72 @@ class BaseTest(unittest.TestCase):
 
         try:
             self.assertTrue(x.check())
-            files[1].remove('a.txt')
+            files.remove('a.txt')
             self.assertFalse(x.check())
         except:
             raise
         finally:
-            os.walk = original_walk
+            watchers.scandir = original_scandir
+
+
+    def test_lazy(self):
+        """Should walk a tree during the first check."""
+
+        x = self.class_(CHECK_INTERVAL, lazy=True, **self.kwargs)
+        self.assertFalse(x.ready.is_set())
+
+        # Paths found by the first walk are not created ones.
+        create_file('new.txt')
+        self.assertFalse(x.check())
+        self.assertTrue(x.ready.is_set())
+
+        modify_file('new.txt')
+        self.assertTrue(x.check())
+
+    def test_snapshot_file(self):
+        """Should report changes made since a snapshot was saved."""
+
+        path = tempfile.mkdtemp()
+        filename = os.path.join(path, 'snapshot')
+        try:
+            x = self.class_(CHECK_INTERVAL, recursive=True, **self.kwargs)
+            x.save_snapshot(filename)
+
+            # Nothing changed.
+            x = self.class_(CHECK_INTERVAL, recursive=True, snapshot=filename,
+                            **self.kwargs)
+            self.assertFalse(x.check())
+
+            modify_file('x', 'y', 'foo.py')
+            x = self.class_(CHECK_INTERVAL, recursive=True, snapshot=filename,
+                            **self.kwargs)
+            self.assertTrue(x.check())
+            self.assertFalse(x.check())
+
+            # Snapshot of other directory.
+            kwargs = dict(self.kwargs, path='x')
+            x = self.class_(CHECK_INTERVAL, **kwargs)
+            self.assertRaises(ValueError, x.load_snapshot, filename)
+        finally:
+            shutil.rmtree(path)
+
+    def test_stats(self):
+        """Should record metrics of each check."""
+
+        x = self.class_(CHECK_INTERVAL, recursive=True, **self.kwargs)
+        checks = []
+        x.on_check(checks.append)
+
+        x.check()
+        create_file('new.txt')
+        x.check()
+
+        self.assertEqual([i.events for i in checks], [0, 1])
+        self.assertEqual(list(x.history), checks)
+        stats = x.stats()
+        self.assertEqual(stats.checks, 2)
+        self.assertEqual(stats.events, 1)
+        self.assertEqual(stats.wall_time, sum(i.wall_time for i in checks))
 
 
 class TestWatcher(BaseTest):
@@ -474,13 +613,370 @@ class TestWatcher(BaseTest):
         self.assertTrue(deleted.is_file)
         self.assertEqual(deleted.path, os.path.abspath('new.file'))
 
+    def test_diff(self):
+        """Should return items of all events."""
+
+        x = Watcher(CHECK_INTERVAL, '.')
+        self.assertFalse(x.diff())
+
+        create_file('new.txt')
+        modify_file('a.txt')
+        delete_file('a.py')
+        changes = x.diff()
+        self.assertEqual(len(changes), 3)
+        self.assertEqual([i.path for i in changes.created],
+                         absolute_paths('new.txt'))
+        self.assertEqual([i.path for i in changes.modified],
+                         absolute_paths('a.txt'))
+        self.assertEqual([i.path for i in changes.deleted],
+                         absolute_paths('a.py'))
+
+    def test_on_batch(self):
+        """Should run on_batch event once per check."""
+
+        batches = []
+        x = Watcher(CHECK_INTERVAL, '.')
+        x.on_batch(lambda changes, name: batches.append((name, changes)),
+                   'batch')
+
+        self.assertFalse(x.check())
+        create_file('new.txt')
+        create_file('new.py')
+        self.assertTrue(x.check())
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(batches[0][0], 'batch')
+        self.assertEqual(len(batches[0][1].created), 2)
+
+    def test_moves(self):
+        """Should report a moved file or directory as one event."""
+
+        events = []
+
+        class CustomWatcher(Watcher):
+            def on_created(self, item):
+                events.append(('created', item.path))
+
+            def on_deleted(self, item):
+                events.append(('deleted', item.path))
+
+            def on_moved(self, src, dst):
+                events.append(('moved', src.path, dst.path))
+
+        x = CustomWatcher(CHECK_INTERVAL, recursive=True, moves=True,
+                          **self.kwargs)
+
+        os.rename('a.txt', os.path.join('x', 'b.txt'))
+        self.assertTrue(x.check())
+        self.assertEqual(events, [('moved', os.path.abspath('a.txt'),
+                                   os.path.abspath('x/b.txt'))])
+
+        # Paths inside a moved directory have no events.
+        del events[:]
+        os.rename('x', 'z')
+        create_file('z', 'y', 'new.txt')
+        changes = x.diff()
+        self.assertEqual(sorted(events), [
+            ('created', os.path.abspath('z/y/new.txt')),
+            ('moved', os.path.abspath('x'), os.path.abspath('z'))])
+        self.assertEqual(len(changes.moved), 1)
+
+        # Replaced files are not moved.
+        del events[:]
+        delete_file('a.py')
+        create_file('c.py', data='new')
+        self.assertTrue(x.check())
+        self.assertEqual(sorted(events), [
+            ('created', os.path.abspath('c.py')),
+            ('deleted', os.path.abspath('a.py'))])
+
+        # Moves found by walking split between checks.
+        if self.kwargs.get('backend') == 'inotify':
+            return
+        x = CustomWatcher(CHECK_INTERVAL, recursive=True, moves=True,
+                          slice_dirs=1, **self.kwargs)
+        del events[:]
+        os.rename(os.path.join('z', 'foo.py'), 'moved.py')
+        x.check()
+        while x.lag:
+            x.check()
+        self.assertEqual(events, [('moved', os.path.abspath('z/foo.py'),
+                                   os.path.abspath('moved.py'))])
+
+    def test_walk_stats(self):
+        """Should count paths, directories, stat calls and races."""
+
+        x = Watcher(CHECK_INTERVAL, '.', recursive=True)
+        x.check()
+        stats = x.history[-1]
+        self.assertEqual((stats.paths, stats.dirs, stats.stat_calls,
+                          stats.errors, stats.races), (10, 3, 10, 0, 0))
+
+        # A path deleted between listing and stat.
+        original_scandir = watchers.scandir
+        watchers.scandir = lambda path: original_scandir(path) + \
+            [watchers._DirEntry(path, 'missing')]
+        try:
+            x.check()
+        finally:
+            watchers.scandir = original_scandir
+        stats = x.history[-1]
+        self.assertEqual((stats.paths, stats.stat_calls, stats.races),
+                         (10, 13, 3))
+
+    def test_syscalls(self):
+        """Should stat each path once and list each directory once, the same
+        numbers are counted in stats."""
+
+        paths = sum(len(d) + len(f) for _, d, f in os.walk('.'))
+        for x in (Watcher(CHECK_INTERVAL, '.', recursive=True),
+                  SimpleWatcher(CHECK_INTERVAL, '.', lambda: None,
+                                recursive=True)):
+            stats, listings = count_syscalls(x.check)
+            self.assertEqual(stats, paths)
+            self.assertEqual(stats, x.history[-1].stat_calls)
+            self.assertEqual(listings, 3)
+            self.assertEqual(listings, x.history[-1].dirs)
+
+    def test_budget(self):
+        """Should continue walking in the next check when a budget is used
+        up."""
+
+        bucket = watchers.TokenBucket(0.001, burst=1)
+        x = Watcher(CHECK_INTERVAL, '.', recursive=True, budget=bucket)
+        self.assertEqual(x.budgets, [bucket])
+        self.assertLess(bucket.available(), 0)
+        self.assertGreater(bucket.delay(), 0)
+
+        # The first walk is split too.
+        initial = 0
+        while not x.ready.is_set():
+            self.assertGreater(x.lag, 0)
+            self.assertFalse(x.check())
+            initial += 1
+        self.assertGreater(initial, 1)
+        self.assertEqual(len(x.watched_paths),
+                         len(list(watchers.walk('.', recursive=True))))
+
+        created, deleted = [], []
+        x.on_created(lambda item: created.append(item.path))
+        x.on_deleted(lambda item: deleted.append(item.path))
+        create_file('x', 'y', 'new.txt')
+        delete_file('a.py')
+
+        # Deleted paths are found at the end of walking.
+        checks = 0
+        while not deleted:
+            x.check()
+            checks += 1
+            if not deleted:
+                self.assertGreater(x.lag, 0)
+
+        self.assertEqual(created,
+                         absolute_paths(os.path.join('x', 'y', 'new.txt')))
+        self.assertEqual(deleted, absolute_paths('a.py'))
+        self.assertEqual(x.lag, 0)
+        self.assertGreater(checks, 1)
+        self.assertEqual(x.stats().incomplete, checks - 1)
+
+        self.assertRaises(ValueError, watchers.TokenBucket, 0)
+        self.assertRaises(ValueError, Watcher, 1, '.', budget=10,
+                          processes=2)
+
+    def test_slices(self):
+        """Should split walking into slices and run events of each slice."""
+
+        x = Watcher(CHECK_INTERVAL, '.', recursive=True, slice_dirs=1)
+        events = []
+        x.on_created(lambda item: events.append(('created', item.path)))
+        x.on_deleted(lambda item: events.append(('deleted', item.path)))
+        create_file('x', 'y', 'new.txt')
+        delete_file('a.py')
+
+        checks = 0
+        while not events or events[-1][0] != 'deleted':
+            x.check()
+            checks += 1
+            self.assertLessEqual(x.history[-1].dirs, 1)
+
+        # One check per directory.
+        self.assertEqual(checks, 3)
+        self.assertEqual(events, [
+            ('created', os.path.abspath(os.path.join('x', 'y', 'new.txt'))),
+            ('deleted', os.path.abspath('a.py'))])
+
+        # A change in the first directory of the next slice is found by the
+        # next check.
+        x.on_modified(lambda item: events.append(('modified', item.path)))
+        x.check()
+        del events[:]
+        for i in ('foo.html', 'foo.py', 'foo.txt'):
+            modify_file('x', i)
+        x.check()
+        self.assertEqual(sorted(events), [
+            ('modified', os.path.abspath(os.path.join('x', i)))
+            for i in ('foo.html', 'foo.py', 'foo.txt')])
+
+        # Slices limited by time.
+        x = Watcher(CHECK_INTERVAL, '.', recursive=True, slice_time=1e-9)
+        x.check()
+        self.assertEqual(x.history[-1].paths, 3)
+        self.assertGreater(x.lag, 0)
+
+        self.assertRaises(ValueError, Watcher, 1, '.', slice_dirs=0)
+        self.assertRaises(ValueError, Watcher, 1, '.', sweep=0)
+        self.assertRaises(ValueError, Watcher, 1, '.', slice_dirs=1,
+                          processes=2)
+        self.assertRaises(ValueError, Watcher, 1, '.', slice_time=1,
+                          backend='inotify')
+
+    def test_sweep(self):
+        """Should spread slices to walk the whole tree once per sweep."""
+
+        x = Watcher(10, '.', recursive=True, slice_dirs=1, sweep=3)
+        self.assertEqual(x._next_interval(), 10)
+
+        # Size of a tree is not known yet.
+        x.check()
+        self.assertAlmostEqual(x._next_interval(), 3, delta=0.5)
+        while x.lag:
+            x.check()
+        self.assertAlmostEqual(x._next_interval(), 3, delta=0.5)
+
+        # One of three directories is walked, two slices are left.
+        x._walk_started -= 3
+        x.check()
+        self.assertAlmostEqual(x._next_interval(), 1.5, delta=0.5)
+
+    def test_hashing(self):
+        """Should find changes of contents that keep mtime and size."""
+
+        def preserve_mtime(*path):
+            stat = os.stat(os.path.join(*path))
+            create_file(*path, data='hello world?')
+            os.utime(os.path.join(*path), (stat.st_atime, stat.st_mtime))
+
+        # Files are not racily clean.
+        old = time.time() - 3600
+        for root, dirs, files in os.walk('.'):
+            for i in files:
+                os.utime(os.path.join(root, i), (old, old))
+
+        x = Watcher(CHECK_INTERVAL, '.', recursive=True, hashing=True)
+        y = Watcher(CHECK_INTERVAL, '.', recursive=True)
+        # Files are hashed by the first walk.
+        self.assertEqual(len(x.hashes), 8)
+        preserve_mtime('b.py')
+        self.assertEqual([i.path for i in x.diff().modified],
+                         absolute_paths('b.py'))
+
+        preserve_mtime('a.txt')
+        preserve_mtime('x', 'y', 'foo.txt')
+        self.assertFalse(y.check())
+        self.assertEqual([i.path for i in x.diff().modified], absolute_paths(
+            'a.txt', os.path.join('x', 'y', 'foo.txt')))
+
+        # Unchanged files are not read again.
+        original_hash_file = watchers.hash_file
+        read = []
+        watchers.hash_file = lambda path: read.append(path) or \
+            original_hash_file(path)
+        try:
+            self.assertFalse(x.check())
+            self.assertEqual(read, [])
+
+            # Same content, but a new ctime.
+            os.chmod('a.py', os.stat('a.py').st_mode)
+            os.utime('a.py', (old, old))
+            self.assertFalse(x.check())
+            self.assertEqual(read, absolute_paths('a.py'))
+        finally:
+            watchers.hash_file = original_hash_file
+
+        delete_file('a.txt')
+        self.assertTrue(x.check())
+        self.assertEqual(len(x.hashes), 7)
+
+        # Files are hashed when a snapshot is loaded.
+        x.save_snapshot('snapshot')
+        y = Watcher(CHECK_INTERVAL, '.', recursive=True, hashing=True,
+                    snapshot='snapshot')
+        self.assertEqual(len(y.hashes), 7)
+        preserve_mtime('x', 'foo.txt')
+        self.assertEqual([i.path for i in y.diff().modified],
+                         absolute_paths(os.path.join('x', 'foo.txt')))
+
+        self.assertRaises(ValueError, Watcher, 1, '.', hashing=True,
+                          processes=2)
+
+        # Big files are mapped to memory.
+        data = 'x' * watchers.MMAP_SIZE
+        create_file('big.txt', data=data)
+        self.assertEqual(watchers.hash_file('big.txt'),
+                         hashlib.sha1(data.encode()).digest())
+        self.assertIsNone(watchers.hash_file('missing.txt'))
+
+    def test_debounce(self):
+        """Should merge events of a path until it is not changed."""
+
+        events = []
+
+        class CustomWatcher(Watcher):
+            def on_created(self, item):
+                events.append(('created', os.path.basename(item.path)))
+
+            def on_modified(self, item):
+                events.append(('modified', os.path.basename(item.path)))
+
+            def on_deleted(self, item):
+                events.append(('deleted', os.path.basename(item.path)))
+
+        x = CustomWatcher(CHECK_INTERVAL, '.', debounce=0.5)
+
+        create_file('new.txt')
+        create_file('temp.txt')
+        self.assertTrue(x.check())
+        modify_file('new.txt')
+        delete_file('temp.txt')
+        delete_file('a.txt')
+        self.assertTrue(x.check())
+        create_file('a.txt', data='hello')
+        self.assertTrue(x.check())
+        self.assertEqual(events, [])
+
+        time.sleep(0.5)
+        self.assertFalse(x.check())
+        self.assertEqual(sorted(events), [('created', 'new.txt'),
+                                          ('modified', 'a.txt')])
+
+        events.clear()
+        modify_file('new.txt')
+        self.assertTrue(x.check())
+        x.flush()
+        self.assertEqual(events, [('modified', 'new.txt')])
+
+    def test_debounce_max_wait(self):
+        """Should deliver events of a path changed all the time."""
+
+        events = []
+        x = Watcher(CHECK_INTERVAL, '.', debounce=0.3)
+        x.on_modified(lambda item: events.append(item.path))
+
+        start = time.time()
+        while not events and time.time() - start < 3:
+            modify_file('a.txt')
+            x.check()
+            time.sleep(0.05)
+        self.assertEqual(events, [os.path.abspath('a.txt')])
+        self.assertLess(time.time() - start, 1)
+
     def test_on_file_created(self):
         """Should run an event if a file created."""
 
         i = 0
-        def test(a, b):
+        def test(item, a, b):
             nonlocal i
             i = a + b
+            self.assertIsInstance(item, watchers.Item)
 
         x = Watcher(CHECK_INTERVAL, '.')
         x.on_created(test, 1, b=1)
@@ -492,9 +988,10 @@ class TestWatcher(BaseTest):
         """Should run an event if a file deleted."""
 
         i = 0
-        def test(a, b):
+        def test(item, a, b):
             nonlocal i
             i = a + b
+            self.assertIsInstance(item, watchers.Item)
 
         x = Watcher(CHECK_INTERVAL, '.')
         x.on_deleted(test, 1, b=1)
@@ -506,9 +1003,10 @@ class TestWatcher(BaseTest):
         """Should run an event if a file modified."""
 
         i = 0
-        def test(a, b):
+        def test(item, a, b):
             nonlocal i
             i = a + b
+            self.assertIsInstance(item, watchers.Item)
 
         x = Watcher(CHECK_INTERVAL, '.')
         x.on_modified(test, 1, b=1)
@@ -520,9 +1018,10 @@ class TestWatcher(BaseTest):
         """Should run an event if a directory created."""
 
         i = 0
-        def test(a, b):
+        def test(item, a, b):
             nonlocal i
             i = a + b
+            self.assertIsInstance(item, watchers.Item)
 
         x = Watcher(CHECK_INTERVAL, '.')
         x.on_created(test, 1, b=1)
@@ -534,9 +1033,10 @@ class TestWatcher(BaseTest):
         """Should run an event if a directory deleted."""
 
         i = 0
-        def test(a, b):
+        def test(item, a, b):
             nonlocal i
             i = a + b
+            self.assertIsInstance(item, watchers.Item)
 
         x = Watcher(CHECK_INTERVAL, '.')
         x.on_deleted(test, 1, b=1)
@@ -548,9 +1048,10 @@ class TestWatcher(BaseTest):
         """Should run an event if a directory was modified."""
 
         i = 0
-        def test(a, b):
+        def test(item, a, b):
             nonlocal i
             i = a + b
+            self.assertIsInstance(item, watchers.Item)
 
         x = Watcher(CHECK_INTERVAL, '.')
         x.on_modified(test, 1, b=1)
@@ -570,7 +1071,7 @@ class TestWatcher(BaseTest):
         """Can start a new thread to check a file system changes."""
 
         i = False
-        def function():
+        def function(item):
             nonlocal i
             i = True
 
@@ -624,6 +1125,45 @@ class TestSimpleWatcher(BaseTest):
         x.check()
         self.assertEqual(2, i)
 
+    def test_snapshot(self):
+        """Should keep only a digest of each directory."""
+
+        x = self.class_(CHECK_INTERVAL, '.', lambda: None, recursive=True,
+                        filter=lambda path: path.endswith('.py'))
+        self.assertEqual(absolute_paths('.', 'x', os.path.join('x', 'y')),
+                         sorted(x.snapshot))
+
+        # Digests of parents change too.
+        snapshot = x.snapshot.copy()
+        modify_file('x', 'y', 'foo.py')
+        self.assertTrue(x.check())
+        for i in snapshot:
+            self.assertNotEqual(snapshot[i], x.snapshot[i])
+
+        # Ignored file.
+        modify_file('x', 'y', 'foo.txt')
+        self.assertFalse(x.check())
+
+    def test_cached_digests(self):
+        """Should compute digests only of changed directories."""
+
+        x = self.class_(CHECK_INTERVAL, '.', lambda: None, recursive=True)
+        computed = []
+        original_digest = watchers._digest
+        watchers._digest = lambda records: computed.append(records) or \
+            original_digest(records)
+        try:
+            self.assertFalse(x.check())
+            self.assertEqual(computed, [])
+
+            # A modified directory and its parents.
+            modify_file('x', 'y', 'foo.py')
+            self.assertTrue(x.check())
+            self.assertEqual(len(computed), 3)
+        finally:
+            watchers._digest = original_digest
+        self.assertEqual(watchers.digests(x.path, True), x.snapshot)
+
     def test_thread(self):
         """Can start a new thread to check a file system changes."""
 
@@ -698,6 +1238,608 @@ class TestSimpleWatcher(BaseTest):
         self.assertFalse(thread.is_alive())
 
 
+class TestIncrementalWatcher(BaseTest):
+    """A Watcher in incremental mode"""
+
+    class_ = Watcher
+    kwargs = {
+        'path': '.',
+        'incremental': True
+    }
+
+    def test_listings(self):
+        """Should list only directories with a changed mtime."""
+
+        # Directories modified long time ago.
+        for i in ('.', 'x', os.path.join('x', 'y')):
+            os.utime(i, (0, 0))
+
+        listed = []
+        original_scandir = watchers.scandir
+        def scandir(path):
+            listed.append(path)
+            return original_scandir(path)
+
+        x = self.class_(CHECK_INTERVAL, recursive=True, **self.kwargs)
+        self.assertEqual(3, len(x.listings))
+
+        watchers.scandir = scandir
+        try:
+            # File modified, listings are not changed.
+            modify_file('x', 'y', 'foo.py')
+            self.assertTrue(x.check())
+            self.assertEqual([], listed)
+
+            # Directory content changed.
+            create_file('x', 'new.py')
+            self.assertTrue(x.check())
+            self.assertEqual([os.path.abspath('x')], listed)
+
+            # Deleted directory is forgotten.
+            delete_dir('x')
+            self.assertTrue(x.check())
+            self.assertEqual(1, len(x.listings))
+        finally:
+            watchers.scandir = original_scandir
+
+    def test_replaced_dir(self):
+        """Should list a directory replaced by one with the same mtime."""
+
+        create_dir('current')
+        create_file('current', 'a.txt')
+        create_dir('staging')
+        create_file('staging', 'a.txt')
+        create_file('staging', 'b.txt')
+        for i in ('current', 'staging'):
+            os.utime(i, (0, 0))
+
+        created = []
+        x = self.class_(CHECK_INTERVAL, recursive=True, **self.kwargs)
+        x.on_created(lambda item: created.append(item.path))
+
+        os.rename('current', 'old')
+        os.rename('staging', 'current')
+        self.assertTrue(x.check())
+        self.assertIn(os.path.abspath(os.path.join('current', 'b.txt')),
+                      created)
+
+
+class TestParallelWatcher(BaseTest):
+    """A Watcher that reads directories using threads"""
+
+    class_ = Watcher
+    kwargs = {
+        'path': '.',
+        'workers': 4
+    }
+
+    def test_walk(self):
+        """Should walk in the same order as without threads."""
+
+        for i in range(20):
+            create_dir('x', str(i))
+            create_file('x', str(i), 'foo.py')
+
+        x = self.class_(CHECK_INTERVAL, **self.kwargs)
+        paths = [i for i, stat in watchers.walk('.', recursive=True)]
+        self.assertEqual(paths, [i for i, stat in watchers.walk(
+            '.', recursive=True, executor=x.executor)])
+
+    def test_slices(self):
+        """Should not count directories read ahead in slices."""
+
+        for i in range(10):
+            create_dir('dir' + str(i))
+            create_file('dir' + str(i), 'foo.py')
+
+        checks = []
+        for workers in (None, 4):
+            x = Watcher(CHECK_INTERVAL, '.', recursive=True, slice_dirs=1,
+                        workers=workers)
+            x.check()
+            i = 1
+            while x.lag:
+                x.check()
+                i += 1
+            checks.append(i)
+        self.assertEqual(checks[0], checks[1])
+
+    def test_walk_ahead(self):
+        """Should read a limited number of directories in advance and cancel
+        them if walking is abandoned."""
+
+        for i in range(20):
+            create_dir('dir' + str(i))
+            create_file('dir' + str(i), 'foo.py')
+
+        roots = []
+        futures = []
+
+        class Executor(concurrent.futures.ThreadPoolExecutor):
+            def submit(self, function, root, *args):
+                roots.append(root)
+                futures.append(super().submit(function, root, *args))
+                return futures[-1]
+
+        # Only the watched directory and the first one inside can be read.
+        gate = threading.Event()
+        def read_directory(root, *args):
+            if root not in roots[:2]:
+                gate.wait()
+            return original(root, *args)
+
+        executor = Executor(1)
+        original = watchers._read_directory
+        watchers._read_directory = read_directory
+        try:
+            x = watchers.walk('.', recursive=True, executor=executor, ahead=3)
+            for path, stat in x:
+                if path.endswith('foo.py'):
+                    break
+            self.assertLessEqual(sum(not i.done() for i in futures), 3)
+            x.close()
+        finally:
+            gate.set()
+            watchers._read_directory = original
+        executor.shutdown()
+
+        self.assertTrue(any(i.cancelled() for i in futures))
+        self.assertLess(len(futures), 20)
+
+
+class TestParallelSimpleWatcher(BaseTest):
+    """A SimpleWatcher that reads directories using threads"""
+
+    class_ = SimpleWatcher
+    kwargs = {
+        'path': '.',
+        'target': lambda: True,
+        'workers': 4
+    }
+
+
+def filter_py(path):
+    """Picklable filter used by worker processes."""
+    return path.endswith('.py')
+
+
+class TestProcessWatcher(BaseTest):
+    """A Watcher that scans directories using processes"""
+
+    class_ = Watcher
+    kwargs = {
+        'path': '.',
+        'processes': 2
+    }
+
+    def test_events(self):
+        """Should report the same events as without processes."""
+
+        events = []
+
+        class CustomWatcher(Watcher):
+            def on_created(self, item):
+                events.append(('created', item.path))
+
+            def on_modified(self, item):
+                events.append(('modified', item.path))
+
+            def on_deleted(self, item):
+                events.append(('deleted', item.path))
+
+        x = CustomWatcher(CHECK_INTERVAL, '.', recursive=True, processes=2)
+        y = CustomWatcher(CHECK_INTERVAL, '.', recursive=True)
+
+        create_file('x', 'y', 'new.py')
+        modify_file('x', 'foo.py')
+        delete_dir(os.path.join('x', 'y'))
+        create_dir('z')
+        create_file('z', 'new.py')
+
+        self.assertTrue(x.check())
+        expected = sorted(events)
+        events.clear()
+        self.assertTrue(y.check())
+        self.assertEqual(expected, sorted(events))
+        self.assertEqual(set(x.watched_paths), set(y.watched_paths))
+        self.assertIsNotNone(x._pool)
+
+    def test_budget(self):
+        """Should not share a budget with processes."""
+
+        x = self.class_(CHECK_INTERVAL, recursive=True, **self.kwargs)
+        self.assertRaises(ValueError, Manager(budget=10).add, x)
+
+    def test_simple_watcher(self):
+        """Should compute the same digests as without processes."""
+
+        x = SimpleWatcher(CHECK_INTERVAL, '.', lambda: None, recursive=True,
+                          filter=filter_py, processes=2)
+        y = SimpleWatcher(CHECK_INTERVAL, '.', lambda: None, recursive=True,
+                          filter=filter_py)
+        self.assertEqual(x.snapshot, y.snapshot)
+
+        modify_file('x', 'y', 'foo.py')
+        self.assertTrue(x.check())
+        self.assertTrue(y.check())
+        self.assertEqual(x.snapshot, y.snapshot)
+
+        self.assertRaises(ValueError, SimpleWatcher, CHECK_INTERVAL, '.',
+                          lambda: None, filter=lambda path: True, processes=2)
+
+    def test_prune(self):
+        """Should prune directories even if a filter is not picklable."""
+
+        def prune(path):
+            return watchers.PRUNE if os.path.basename(path) == 'y' else True
+
+        x = Watcher(CHECK_INTERVAL, '.', recursive=True, filter=prune,
+                    processes=2)
+        self.assertIsNone(x._pool_filter)
+        self.assertNotIn(os.path.abspath('x/y/foo.py'), x.watched_paths)
+
+        create_file('x', 'y', 'new.py')
+        self.assertFalse(x.check())
+        create_file('x', 'new.py')
+        self.assertTrue(x.check())
+
+
+@unittest.skipIf(watchers.Inotify.get() is None, 'Inotify not available!')
+class TestInotifyWatcher(BaseTest):
+    """A Watcher using inotify"""
+
+    class_ = Watcher
+    kwargs = {
+        'path': '.',
+        'backend': 'inotify'
+    }
+
+    def test_backend(self):
+        """Should use inotify backend."""
+
+        x = self.class_(CHECK_INTERVAL, **self.kwargs)
+        self.assertEqual('inotify', x.backend)
+        self.assertRaises(ValueError, Watcher, CHECK_INTERVAL, '.',
+                          backend='foo')
+
+    test_moves = TestWatcher.test_moves
+
+    def test_move_dir(self):
+        """Should detect paths inside moved directories."""
+
+        created = []
+        deleted = []
+
+        class CustomWatcher(Watcher):
+            def on_created(self, item):
+                created.append(item.path)
+
+            def on_deleted(self, item):
+                deleted.append(item.path)
+
+        x = CustomWatcher(CHECK_INTERVAL, '.', recursive=True,
+                          backend='inotify')
+        os.rename('x', 'z')
+        self.assertTrue(x.check())
+        self.assertIn(os.path.abspath(os.path.join('z', 'y', 'foo.py')),
+                      created)
+        self.assertIn(os.path.abspath(os.path.join('x', 'y', 'foo.py')),
+                      deleted)
+
+        # New directory is watched too.
+        create_file('z', 'y', 'new.py')
+        self.assertTrue(x.check())
+        self.assertFalse(x.check())
+
+    def test_latency(self):
+        """Should check as soon as the kernel reports an event."""
+
+        i = False
+        def function(item):
+            nonlocal i
+            i = True
+
+        x = self.class_(60, **self.kwargs)
+        x.on_created(function)
+        x.start()
+        # First check runs at once.
+        time.sleep(0.1)
+
+        create_file('new.file')
+        start = time.time()
+        while not i and time.time() - start < 5:
+            time.sleep(0.01)
+        x.stop()
+        self.assertTrue(i)
+
+    def test_budget(self):
+        """Should leave paths reported by inotify to the next check when
+        a budget is used up."""
+
+        created = []
+        x = self.class_(CHECK_INTERVAL, **self.kwargs)
+        x.on_created(lambda item: created.append(item.path))
+        x.budgets.append(watchers.TokenBucket(0.001, burst=0.5))
+
+        for i in range(3):
+            create_file('new{}.txt'.format(i))
+        for i in range(3):
+            self.assertTrue(x.check())
+            self.assertEqual(len(created), i + 1)
+        self.assertFalse(x.check())
+        self.assertEqual(x.stats().incomplete, 2)
+
+    def test_throttle(self):
+        """Should not run checks woken by inotify all the time."""
+
+        x = self.class_(10, **self.kwargs)
+        x._measure(lambda: time.sleep(0.1))
+        self.assertAlmostEqual(x._wake_delay(), 10 * 0.1, delta=0.1)
+
+        # At least once per interval.
+        x = self.class_(0.5, **self.kwargs)
+        x._measure(lambda: time.sleep(0.1))
+        self.assertLessEqual(x._wake_delay(), 0.5)
+
+    def test_fallback(self):
+        """Should use polling if inotify limits are reached."""
+
+        def add_watch(*args):
+            raise OSError(28, 'No space left on device')
+
+        original = watchers.Inotify.add_watch
+        watchers.Inotify.add_watch = add_watch
+        try:
+            x = self.class_(CHECK_INTERVAL, recursive=True, **self.kwargs)
+        finally:
+            watchers.Inotify.add_watch = original
+
+        self.assertEqual('polling', x.backend)
+        create_file('x', 'new.file')
+        self.assertTrue(x.check())
+
+    def test_missing(self):
+        """Should use polling if a watched directory does not exist."""
+
+        x = self.class_(CHECK_INTERVAL, 'missing', recursive=True,
+                        backend='inotify')
+        self.assertEqual('polling', x.backend)
+        create_dir('missing')
+        create_file('missing', 'new.file')
+        self.assertTrue(x.check())
+
+
+@unittest.skipIf(watchers.Inotify.get() is None, 'Inotify not available!')
+class TestInotifySimpleWatcher(BaseTest):
+    """A SimpleWatcher using inotify"""
+
+    class_ = SimpleWatcher
+    kwargs = {
+        'path': '.',
+        'target': lambda: True,
+        'backend': 'inotify'
+    }
+
+    def test_reported_dirs(self):
+        """Should read again only directories reported by inotify."""
+
+        x = self.class_(CHECK_INTERVAL, '.', lambda: None, recursive=True,
+                        backend='inotify')
+        for i in range(10):
+            create_dir('x', 'y', 'z{}'.format(i))
+            create_file('x', 'y', 'z{}'.format(i), 'foo.py')
+
+        # New directories are walked, the others are reused.
+        self.assertTrue(x.check())
+        self.assertEqual(watchers.digests(x.path, True), x.snapshot)
+
+        modify_file('x', 'y', 'z5', 'foo.py')
+        stats, listings = count_syscalls(x.check)
+        self.assertEqual(watchers.digests(x.path, True), x.snapshot)
+        # A modified directory and its parents.
+        self.assertEqual(4, listings)
+
+        delete_dir('x', 'y')
+        os.rename('x', 'w')
+        self.assertTrue(x.check())
+        self.assertEqual(watchers.digests(x.path, True), x.snapshot)
+        self.assertFalse(x.check())
+
+
+class TestFilter(unittest.TestCase):
+    """Filters and pruning of directories."""
+
+    def setUp(self):
+        self.path = create_test_files()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_patterns(self):
+        """Should match globs and regular expressions."""
+
+        x = Filter(include=['*.py', 'x/*.html'], exclude='y',
+                   exclude_regex=r'/b\.')
+
+        self.assertTrue(x('/temp/a.py'))
+        self.assertTrue(x('/temp/x/foo.html'))
+        self.assertFalse(x('/temp/foo.html'))
+        self.assertFalse(x('/temp/x/z/foo.html'))
+        self.assertFalse(x('/temp/a.txt'))
+        self.assertIs(x('/temp/b.py'), watchers.PRUNE)
+        self.assertIs(x('/temp/x/y'), watchers.PRUNE)
+        self.assertTrue(x('/temp/x/yy.py'))
+
+        # Everything is included by default.
+        x = Filter(exclude=['**/build/*.o', '[!a]?.txt'])
+        self.assertTrue(x('/temp/a.txt'))
+        self.assertTrue(x('/temp/build/a.py'))
+        self.assertIs(x('/temp/x/build/a.o'), watchers.PRUNE)
+        self.assertIs(x('/temp/xy.txt'), watchers.PRUNE)
+        self.assertTrue(x('/temp/ay.txt'))
+
+        # Pattern '**/' matches zero directories too.
+        x = Filter(include=['src/**/*.py', '**/x'])
+        self.assertTrue(x('/temp/src/a.py'))
+        self.assertTrue(x('/temp/src/y/z/a.py'))
+        self.assertFalse(x('/temp/src/a.txt'))
+        self.assertFalse(x('/temp/srcx/a.py'))
+        self.assertTrue(x('x'))
+        self.assertTrue(x('/temp/y/x'))
+        self.assertFalse(x('/temp/yx'))
+
+        # Each regular expression has its own flags.
+        x = Filter(include_regex=[r'(?i)\.PY\Z', r'\.txt\Z'])
+        self.assertTrue(x('/temp/a.py'))
+        self.assertTrue(x('/temp/a.txt'))
+        self.assertFalse(x('/temp/a.TXT'))
+
+    def test_root(self):
+        """Should match paths relative to a watched directory."""
+
+        x = Filter(exclude_regex='^x/')
+        self.assertTrue(x(os.path.join(self.path, 'x', 'foo.py')))
+        y = x.bind(self.path)
+        self.assertIsNone(x.root)
+        self.assertIs(y(os.path.join(self.path, 'x', 'foo.py')),
+                      watchers.PRUNE)
+        self.assertTrue(y(os.path.join(self.path, 'a.py')))
+
+        # Parents of a watched directory are not matched.
+        w = Watcher(CHECK_INTERVAL, self.path, recursive=True,
+                    filter=Filter(exclude_regex=re.escape(
+                        os.path.basename(self.path))))
+        self.assertEqual(w.filter.root, self.path)
+        self.assertIn(os.path.join(self.path, 'x', 'foo.py'), w.watched_paths)
+
+    def test_walk(self):
+        """Should not enter pruned directories."""
+
+        paths = []
+
+        def prune(path):
+            paths.append(path)
+            return watchers.PRUNE if os.path.basename(path) == 'y' else True
+
+        result = [p for p, stat in watchers.walk(self.path, True, prune)]
+        self.assertNotIn(os.path.join(self.path, 'x', 'y'), result)
+        self.assertIn(os.path.join(self.path, 'x', 'foo.py'), result)
+        self.assertFalse([i for i in paths
+                          if i.startswith(os.path.join(self.path, 'x', 'y',
+                                                       ''))])
+
+    def test_pickle(self):
+        """Should stay the same in worker processes."""
+
+        import pickle
+        self.assertIs(pickle.loads(pickle.dumps(watchers.PRUNE)),
+                      watchers.PRUNE)
+        x = pickle.loads(pickle.dumps(Filter(exclude='y')))
+        self.assertIs(x('/temp/y'), watchers.PRUNE)
+
+
+class TestPathTable(unittest.TestCase):
+    """A PathTable"""
+
+    def setUp(self):
+        self.path = create_test_files()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_repr(self):
+        print(watchers.PathTable())
+
+    def test(self):
+        """Should store compared fields of paths and compare them."""
+
+        a = os.path.join(self.path, 'a.txt')
+        x = watchers.PathTable()
+        x.add(a, os.stat(a))
+        x.add(self.path, os.stat(self.path))
+
+        self.assertEqual(len(x), 2)
+        self.assertIn(a, x)
+        self.assertIs(x.is_dir(self.path), True)
+        self.assertIs(x.is_dir(a), False)
+        self.assertIsNone(x.is_dir('missing'))
+
+        item = x[a]
+        self.assertTrue(item.is_file)
+        self.assertEqual(item.inode, (os.stat(a).st_dev, os.stat(a).st_ino))
+        self.assertEqual(item.stat.st_size, os.stat(a).st_size)
+
+        self.assertFalse(x.is_modified(a, os.stat(a)))
+        modify_file(a)
+        self.assertTrue(x.is_modified(a, os.stat(a)))
+        self.assertFalse(x.is_modified(a, os.stat(a)))
+
+        # Comparing with a different type.
+        self.assertIsNone(x.compare(a, os.stat(self.path)))
+        self.assertIsNone(x.compare('missing', os.stat(a)))
+        self.assertIs(x.compare(a, os.stat(a)), False)
+
+        # Rows of removed paths are used again.
+        x.pop(a)
+        x.add(a, os.stat(a))
+        self.assertEqual(len(x._columns[0]), 2)
+
+    def test_sweep(self):
+        """Should remove paths not marked during a sweep."""
+
+        x = watchers.PathTable()
+        paths = [os.path.join(self.path, i) for i in ('a.py', 'b.py', 'x')]
+        for i in paths:
+            x.add(i, os.stat(i))
+
+        x.mark()
+        x.is_modified(paths[0], os.stat(paths[0]))
+        x.add(paths[2], os.stat(paths[2]))
+        x.add(self.path, os.stat(self.path))
+        self.assertEqual([i.path for i in x.sweep()], [paths[1]])
+        self.assertEqual(set(x), {paths[0], paths[2], self.path})
+
+    def test_names(self):
+        """Should store each name once and find paths inside a directory."""
+
+        x = watchers.PathTable()
+        stat = os.stat(self.path)
+        for i in range(10):
+            x.add(os.path.join(self.path, str(i)), stat)
+            x.add(os.path.join(self.path, str(i), 'a.txt'), stat)
+        self.assertEqual(len(x), 20)
+        names = [i for entries in x._entries.values() for i in entries
+                 if i == 'a.txt']
+        self.assertEqual(len(names), 10)
+        self.assertEqual(len({id(i) for i in names}), 1)
+
+        self.assertEqual(set(x.under(os.path.join(self.path, '1'))),
+                         {os.path.join(self.path, '1', 'a.txt')})
+        self.assertEqual(len(x.under(self.path)), 20)
+        self.assertEqual(x.under('missing'), [])
+
+        # Names that do not repeat are not shared.
+        for i in range(watchers.PathTable.SHARED_NAMES):
+            x.add(os.path.join(self.path, 'x', 'unique' + str(i)), stat)
+        self.assertIsNone(x._shared)
+        self.assertIn(os.path.join(self.path, 'x', 'unique0'), x)
+
+    def test_compact(self):
+        """Should build the table again when most rows are not used."""
+
+        x = watchers.PathTable()
+        stat = os.stat(self.path)
+        paths = [os.path.join(self.path, str(i)) for i in range(3000)]
+        for i in paths:
+            x.add(i, stat)
+        for i in paths[100:]:
+            x.pop(i)
+
+        self.assertEqual(set(x), set(paths[:100]))
+        self.assertLess(len(x._columns[0]), 2000)
+        self.assertLess(len(x._names), 2000)
+
+
 class TestManager(unittest.TestCase):
     """A Manager"""
 
@@ -794,7 +1936,7 @@ class TestManager(unittest.TestCase):
         """Can start a new thread to check each watcher."""
 
         i = False
-        def function():
+        def function(item):
             nonlocal i
             i = True
 
@@ -815,6 +1957,91 @@ class TestManager(unittest.TestCase):
         m.stop()
         self.assertEqual([], [i for i in m.watchers if i.is_alive])
 
+    def test_wait(self):
+        """Can wait for lazy watchers."""
+
+        m = Manager()
+        for i in range(10):
+            m.add(Watcher(CHECK_INTERVAL, '.', recursive=True, lazy=True))
+
+        self.assertFalse(m.wait(0))
+        m.start()
+        self.assertTrue(m.wait(5))
+        m.stop()
+
+    def test_stats(self):
+        """Should sum metrics of watchers."""
+
+        m = Manager()
+        self.assertEqual(m.percentiles(), {50: None, 90: None, 99: None})
+
+        for i in range(3):
+            m.add(Watcher(CHECK_INTERVAL, '.', recursive=True))
+        m.check()
+        m.check()
+
+        stats = m.stats()
+        self.assertEqual(stats.checks, 6)
+        self.assertEqual(stats.paths, 60)
+        self.assertEqual(m.percentiles('paths', (0, 50, 100)),
+                         {0: 10, 50: 10, 100: 10})
+
+    def test_budget(self):
+        """Should share a budget between watchers."""
+
+        m = Manager(budget=100)
+        x = Watcher(CHECK_INTERVAL, '.')
+        m.add(x)
+        self.assertEqual(x.budgets, [m.budget])
+        m.remove(x)
+        self.assertEqual(x.budgets, [])
+        m.add(x)
+        m.clear()
+        self.assertEqual(x.budgets, [])
+
+    def test_metrics(self):
+        """Should export metrics in the OpenMetrics text format."""
+
+        m = Manager()
+        x = Watcher(CHECK_INTERVAL, '.', recursive=True)
+        m.add(x)
+        x.check()
+
+        label = '{{watcher="{}",id="{:x}"}}'.format(
+            repr(x).replace('\\', '\\\\'), id(x))
+        lines = m.metrics().splitlines()
+        self.assertEqual(lines[-1], '# EOF')
+        self.assertIn('watchers_checks_total' + label + ' 1', lines)
+        self.assertIn('watchers_tree_size' + label + ' 10', lines)
+        self.assertIn('watchers_check_seconds_count' + label + ' 1', lines)
+        self.assertIn('watchers_check_seconds_bucket' + label[:-1] +
+                      ',le="+Inf"} 1', lines)
+
+        # Watchers with the same repr() have different labels.
+        m.add(Watcher(CHECK_INTERVAL, '.', recursive=True))
+        lines = [i for i in m.metrics().splitlines()
+                 if i.startswith('watchers_checks_total')]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(len({i.split('}')[0] for i in lines}), 2)
+        m.clear()
+        m.add(x)
+
+        # Served over HTTP.
+        server = m.serve_metrics(0)
+        try:
+            url = 'http://localhost:{}/metrics'.format(server.server_address[1])
+            with urllib.request.urlopen(url) as response:
+                self.assertEqual(response.read().decode(), m.metrics())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # Written to a file.
+        filename = os.path.join(self.temp_path, 'metrics.prom')
+        watchers.MetricsWriter(CHECK_INTERVAL, m, filename).check()
+        with open(filename) as file:
+            self.assertEqual(file.read(), m.metrics())
+
     def test_change_watchers_in_check(self):
         """Should handle changing watchers set during check() method."""
 
@@ -830,45 +2057,451 @@ class TestManager(unittest.TestCase):
         m.stop()
 
 
-# Prevent testing base class.
-del BaseTest
+class TestAdaptiveInterval(unittest.TestCase):
+    """An AdaptiveInterval"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.temp_path = create_test_files()
+        os.chdir(self.temp_path)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.temp_path)
+
+    def test_repr(self):
+        print(watchers.AdaptiveInterval(1, 60))
+
+    def test_update(self):
+        """Should grow without changes and fall after a change."""
+
+        x = watchers.AdaptiveInterval(1, 5, growth=2, cost=10)
+        self.assertEqual([x.update(False, 0) for i in range(4)], [2, 4, 5, 5])
+        self.assertEqual(x.update(True, 0), 1)
+        # Never shorter than cost times a check duration.
+        self.assertEqual(x.update(True, 0.3), 3)
+        self.assertEqual(x.update(False, 1), 10)
+        self.assertEqual(x.update(False, 0), 4)
+
+        self.assertRaises(ValueError, watchers.AdaptiveInterval, 0, 1)
+        self.assertRaises(ValueError, watchers.AdaptiveInterval, 2, 1)
+        self.assertRaises(ValueError, watchers.AdaptiveInterval, 1, 2, 0.5)
+
+    def test_watcher(self):
+        """Should change an interval of a watcher after each check."""
+
+        for x in (Watcher(watchers.AdaptiveInterval(0.5, 4, cost=0), '.'),
+                  SimpleWatcher(watchers.AdaptiveInterval(0.5, 4, cost=0),
+                                '.', lambda: None)):
+            self.assertEqual(x.interval, 0.5)
+            x.check()
+            x.check()
+            self.assertEqual(x.interval, 2)
+            create_file('new.txt')
+            x.check()
+            self.assertEqual(x.interval, 0.5)
+            delete_file('new.txt')
+
+        # Watchers sharing an instance adapt independently.
+        interval = watchers.AdaptiveInterval(0.5, 4, cost=0)
+        x = Watcher(interval, '.')
+        y = Watcher(interval, '.')
+        x.check()
+        x.check()
+        self.assertEqual(x.interval, 2)
+        self.assertEqual(y.interval, 0.5)
+        y.check()
+        self.assertEqual(y.interval, 1)
+        self.assertEqual(interval.value, 0.5)
+
+
+class TestScheduler(unittest.TestCase):
+    """A Scheduler"""
+
+    def setUp(self):
+
+        self.cwd = os.getcwd()
+        self.temp_path = create_test_files()
+        os.chdir(self.temp_path)
+
+    def tearDown(self):
+
+        os.chdir(self.cwd)
+        shutil.rmtree(self.temp_path)
+
+    def test_repr(self):
+        print(Scheduler())
+
+    def test_shared_threads(self):
+        """Should check many watchers using a fixed number of threads."""
+
+        scheduler = Scheduler(workers=2)
+        checked = set()
+
+        class CountingWatcher(SimpleWatcher):
+            def check(self):
+                checked.add(self)
+                return super().check()
+
+        threads = threading.active_count()
+        m = Manager()
+        for i in range(50):
+            x = CountingWatcher(CHECK_INTERVAL, '.', lambda: None)
+            x.scheduler = scheduler
+            m.add(x)
+        m.start()
+        self.assertLessEqual(threading.active_count(), threads + 2)
+
+        while len(checked) < 50:
+            time.sleep(0.01)
+
+        m.stop()
+        self.assertEqual([], [i for i in m.watchers if i.is_alive])
+        # Threads end when there is nothing to check.
+        self.assertEqual(threads, threading.active_count())
+
+    def test_restart(self):
+        """Can start a stopped watcher again."""
+
+        i = 0
+        def function():
+            nonlocal i
+            i += 1
 
+        x = SimpleWatcher(CHECK_INTERVAL, '.', function)
+        x.scheduler = Scheduler()
+        x.start()
+        x.stop()
+        self.assertFalse(x.is_alive)
 
-# Benchmark
+        x.start()
+        create_file('new.file')
+        while not i:
+            time.sleep(0.01)
+        self.assertTrue(x.stop())
+        self.assertFalse(x.is_alive)
 
-def benchmark(times=10000):
-    """Benchmarks each watcher."""
+    def test_policies(self):
+        """Should keep a rate of checks or a delay between them."""
 
-    # Prepare temp directory with example files.
-    cwd = os.getcwd()
-    path = create_test_files()
-    os.chdir(path)
+        def periods(policy):
+            times = []
 
-    msg = 'Watching {} files in {} directories.'.format(8 * times, 2 * times)
-    print(msg)
+            class SlowWatcher(watchers.BaseWatcher):
+                def check(self):
+                    times.append(watchers.monotonic())
+                    time.sleep(0.1)
 
-    x = timeit.timeit('Watcher(1, ".", recursive=True).check()',
-                      setup='from watchers import Watcher', number=times)
+            x = SlowWatcher(0.2, policy, scheduler=Scheduler())
+            x.start()
+            while len(times) < 4:
+                time.sleep(0.01)
+            x.stop()
+            return [b - a for a, b in zip(times, times[1:])]
+
+        for i in periods('fixed-rate'):
+            self.assertAlmostEqual(i, 0.2, delta=0.05)
+        for i in periods('fixed-delay'):
+            self.assertAlmostEqual(i, 0.3, delta=0.05)
+
+        x = watchers.BaseWatcher(0.1)
+        x.policy = 'foo'
+        self.assertRaises(ValueError, x.start)
+        self.assertRaises(ValueError, Watcher, 1, '.', policy='foo')
+
+    def test_overrun(self):
+        """Should skip checks missed by an overrun."""
+
+        x = watchers.BaseWatcher(0.1)
+        x.policy = 'fixed-rate'
+        x._due = watchers.monotonic() - 0.25
+        delay = x._policy_delay(0.1)
+        self.assertGreater(delay, 0)
+        self.assertAlmostEqual(delay, 0.05, delta=0.02)
+
+    def test_jitter(self):
+        """Should spread checks of watchers over their interval."""
+
+        x = watchers.BaseWatcher(1, 'jitter')
+        for i in range(100):
+            self.assertTrue(0.9 <= x._policy_delay(1) <= 1.1)
+        for i in (-0.1, 1.5):
+            self.assertRaises(ValueError, SimpleWatcher, 1, '.', None,
+                              policy='jitter', jitter=i)
 
-    sample = round(x / (8 * times) * 1000, 3)
+        m = Manager()
+        for i in range(10):
+            x = watchers.BaseWatcher(10)
+            x.policy = 'jitter'
+            x.scheduler = Scheduler()
+            m.add(x)
+        now = watchers.monotonic()
+        m.start()
+        phases = sorted(int(i._due - now) for i in m.watchers)
+        m.stop()
+        self.assertEqual(phases, list(range(10)))
 
-    print('Watcher: \t{} s. one file: {} ms.'.format(round(x, 3), sample))
 
-    x = timeit.timeit(
-        'SimpleWatcher(1, ".", target=lambda: 1, recursive=True).check()',
-        setup='from watchers import SimpleWatcher', number=times)
+class TestDispatcher(unittest.TestCase):
+    """A Dispatcher"""
 
-    sample = round(x / (8 * times) * 1000, 3)
-    print('SimpleWatcher: \t{} s. one file: {} ms.'.format(round(x, 3), sample))
+    def setUp(self):
+
+        self.cwd = os.getcwd()
+        self.temp_path = create_test_files()
+        os.chdir(self.temp_path)
+
+    def tearDown(self):
 
-    # Cleaning!
-    shutil.rmtree(path)
-    os.chdir(cwd)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.temp_path)
+
+    def test_repr(self):
+        print(Dispatcher())
+
+    def test_block(self):
+        """Should run all callbacks in order."""
+
+        result = []
+        x = Dispatcher(maxsize=2)
+        for i in range(20):
+            x.put(None, result.append, (i,))
+        self.assertTrue(x.join(5))
+        self.assertEqual(result, list(range(20)))
+
+        self.assertRaises(ValueError, Dispatcher, policy='unknown')
+
+    def test_drop(self):
+        """Should drop the oldest events when the queue is full."""
+
+        result = []
+        event = threading.Event()
+        x = Dispatcher(maxsize=2, policy='drop')
+        x.put(None, event.wait)
+        while x._queue:
+            time.sleep(0.01)
+
+        for i in range(5):
+            x.put(None, result.append, (i,))
+        event.set()
+        self.assertTrue(x.join(5))
+        self.assertEqual(result, [3, 4])
+        self.assertEqual(x.dropped, 3)
+
+    def test_coalesce(self):
+        """Should merge waiting events with the same key when the queue is
+        full."""
+
+        result = []
+        event = threading.Event()
+        x = Dispatcher(maxsize=2, policy='coalesce')
+        x.put('wait', event.wait)
+        while x._queue:
+            time.sleep(0.01)
+
+        for i in range(5):
+            x.put(i % 2, result.append, (i,))
+        event.set()
+        self.assertTrue(x.join(5))
+        self.assertEqual(result, [3, 4])
+
+        # Events are not merged if there is a free place.
+        result = []
+        x = Dispatcher(policy='coalesce')
+        x.put('wait', event.wait)
+        for i in range(5):
+            x.put(i % 2, result.append, (i,))
+        self.assertTrue(x.join(5))
+        self.assertEqual(result, [0, 1, 2, 3, 4])
+
+    def test_coalesce_events(self):
+        """Should merge events of a path like debouncing."""
+
+        class CustomWatcher:
+            def __init__(self):
+                self.events = []
+            def on_created(self, item):
+                self.events.append(('created', item.path))
+            def on_modified(self, item):
+                self.events.append(('modified', item.path))
+            def on_deleted(self, item):
+                self.events.append(('deleted', item.path))
+
+        a = watchers.Item('a.py')
+        b = watchers.Item('b.py')
+        w = CustomWatcher()
+        event = threading.Event()
+        x = Dispatcher(maxsize=2, policy='coalesce')
+        x.put('wait', event.wait)
+        while x._queue:
+            time.sleep(0.01)
+
+        x.put_event(w, 'on_created', a)
+        x.put_event(w, 'on_created', b)
+        # The queue is full, created and deleted path is not reported.
+        x.put_event(w, 'on_deleted', a)
+        x.put_event(w, 'on_created', a)
+        # Merged event is the newest one.
+        x.put_event(w, 'on_modified', b)
+        event.set()
+        self.assertTrue(x.join(5))
+        self.assertEqual(w.events, [('created', 'a.py'), ('created', 'b.py')])
+
+    def test_watcher(self):
+        """Should run events outside of the check thread."""
+
+        threads = []
+        event = threading.Event()
+
+        class CustomWatcher(Watcher):
+            def on_created(self, item):
+                event.wait()
+                threads.append((threading.current_thread(), item.path))
+
+        dispatcher = Dispatcher()
+        x = CustomWatcher(CHECK_INTERVAL, '.', dispatcher=dispatcher)
+        y = SimpleWatcher(CHECK_INTERVAL, '.', threads.append,
+                          args=('target',), dispatcher=dispatcher)
+
+        create_file('new.txt')
+        self.assertTrue(x.check())
+        self.assertTrue(y.check())
+        self.assertEqual(threads, [])
+
+        event.set()
+        self.assertTrue(dispatcher.join(5))
+        self.assertIsNot(threads[0][0], threading.current_thread())
+        self.assertEqual(threads[0][1], os.path.abspath('new.txt'))
+        self.assertEqual(threads[1], 'target')
+
+
+class TestAsyncWatcher(unittest.TestCase):
+    """An AsyncWatcher and an AsyncManager"""
+
+    def setUp(self):
+
+        self.cwd = os.getcwd()
+        self.temp_path = create_test_files()
+        os.chdir(self.temp_path)
+
+    def tearDown(self):
+
+        os.chdir(self.cwd)
+        shutil.rmtree(self.temp_path)
+
+    def test_repr(self):
+        print(watchers.AsyncWatcher(Watcher(CHECK_INTERVAL, '.')))
+        print(watchers.AsyncManager())
+
+    def test_iterate(self):
+        """Should yield changes found by checks in the event loop."""
+
+        async def main():
+            x = watchers.AsyncWatcher(Watcher(0.05, '.'))
+            create_file('new.py')
+            result = []
+            async for changes in x:
+                result.append(changes)
+                if len(result) == 1:
+                    create_file('new.txt')
+                    delete_file('a.py')
+                else:
+                    await x.stop()
+                    self.assertFalse(await x.stop())
+            return result
+
+        result = asyncio.run(asyncio.wait_for(main(), 10))
+
+        self.assertEqual([i.path for i in result[0].created],
+                         absolute_paths('new.py'))
+        paths = [i.path for i in result[1].created + result[1].deleted]
+        self.assertEqual(paths, absolute_paths('new.txt', 'a.py'))
+
+    def test_manager(self):
+        """Should yield changes of all watchers and stop them."""
+
+        async def main():
+            m = watchers.AsyncManager()
+            a = Watcher(0.05, '.')
+            b = SimpleWatcher(0.05, 'x', lambda: None)
+            m.add(a)
+            m.start()
+            self.assertTrue(m.add(b))
+            self.assertFalse(m.add(b))
+
+            create_file('new.txt')
+            create_file('x', 'new.txt')
+            result = {}
+            async for watcher, changes in m:
+                result[watcher] = changes
+                if len(result) == 2:
+                    await m.stop()
+            self.assertFalse(any(i.is_alive for i in m.watchers.values()))
+            await m.remove(a)
+            return a, b, result
+
+        a, b, result = asyncio.run(asyncio.wait_for(main(), 10))
+        self.assertEqual(len(result[a].created), 1)
+        self.assertIs(result[b], True)
+
+    def test_cancel(self):
+        """Should finish a running check when a task is cancelled."""
+
+        started = threading.Event()
+        event = threading.Event()
+
+        class SlowWatcher(Watcher):
+            def diff(self):
+                started.set()
+                event.wait()
+                return super().diff()
+
+        async def main():
+            x = watchers.AsyncWatcher(SlowWatcher(60, '.'))
+            x.start()
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, started.wait)
+            create_file('new.txt')
+            loop.call_later(0.1, event.set)
+            await x.stop()
+            self.assertFalse(x.is_alive)
+            return x.queue.get_nowait()
+
+        watcher, changes = asyncio.run(asyncio.wait_for(main(), 10))
+        self.assertEqual([i.path for i in changes.created],
+                         absolute_paths('new.txt'))
+
+
+class TestBenchmark(unittest.TestCase):
+    """A benchmark module"""
+
+    def test_run(self):
+        """Should measure watchers on a generated tree."""
+
+        import benchmark
+        x = benchmark.run(sizes=[200], backends=['polling'], changes=5,
+                          repeat=1, interval=0.05)
+        self.assertEqual([(i['watcher'], i['entries']) for i in x['results']],
+                         [('Watcher', 200), ('SimpleWatcher', 200)])
+        self.assertEqual(x['results'][0]['idle_stat_calls'], 200)
+        self.assertGreater(x['results'][0]['peak_memory_bytes'], 0)
+
+        # Trees of each fanout and depth.
+        x = benchmark.run(sizes=[100], fanouts=[2, 5], depths=[1, 2],
+                          kinds=['Watcher'], backends=['polling'], repeat=1,
+                          interval=0.05)
+        self.assertEqual([(i['fanout'], i['depth']) for i in x['results']],
+                         [(2, 1), (2, 2), (5, 1), (5, 2)])
+
+
+# Prevent testing base class.
+del BaseTest
 
 
 if __name__ == "__main__":
 
     if '-b' in sys.argv or '--benchmark' in sys.argv:
-        benchmark()
+        import benchmark
+        benchmark.main([])
     else:
         unittest.main()
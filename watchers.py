@@ -4,36 +4,374 @@ watchers.py
 Script that monitors changes in the file system using watchers instances.
 
 TODO: Documentation
-TODO: Better benchmark function
 
 """
 
 import os
 import sys
+import errno
+import array
+import asyncio
+import bisect
+import concurrent.futures
+import concurrent.futures.process
+import copy
+import hashlib
+import http.server
+import heapq
+import itertools
+import mmap
+import multiprocessing
+import pickle
+import random
+import re
+import select
+import struct
 import threading
+import traceback
+import time
+import weakref
 from stat import *
-from collections import namedtuple
+from time import monotonic
+from collections import deque, namedtuple, OrderedDict
 
 __version__ = '1.0.1-rc.1'
 
-# Minimum python 3.2
-if sys.hexversion < 0x030200F0:
-    raise ImportError('Python < 3.2 not supported!')
+# Minimum python 3.7, asyncio API uses get_running_loop().
+if sys.hexversion < 0x030700F0:
+    raise ImportError('Python < 3.7 not supported!')
 
-# Python 3.2 do not support ns in os.stats!
-PYTHON32 = True if sys.hexversion < 0x030300F0 else False
+
+class Scheduler:
+    """Runs check() methods of many watchers using one shared pool of threads.
+
+    Watchers are kept in a heap ordered by the time of their next check, so
+    a few threads can serve thousands of watchers. Threads are started when
+    the first watcher is scheduled and they end when the last one is removed.
+    """
+
+    def __init__(self, workers=1):
+
+        # Number of threads that run checks.
+        self.workers = workers
+
+        # Heap with (time, entry id, watcher) tuples. Entry ids are unique,
+        # so watchers are never compared.
+        self._heap = []
+        # Watcher -> (time, id) of its only valid entry in the heap. Older
+        # entries are skipped when they are popped.
+        self._entries = {}
+        # Watcher -> thread that is running its check right now.
+        self._running = {}
+        # Watchers woken up during their checks, see wake().
+        self._woken = set()
+        self._threads = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+    def __repr__(self):
+        args = self.__class__.__name__, self.workers, len(self._entries)
+        return "{}(workers={!r}, scheduled={!r})".format(*args)
+
+    def schedule(self, watcher, delay=0):
+        """Runs watcher._prepare_check() in one of threads after delay (in
+        seconds)."""
+
+        with self._condition:
+            if watcher in self._woken:
+                self._woken.discard(watcher)
+                delay = min(delay, watcher._wake_delay())
+
+            entry = next(self._counter)
+            due = monotonic() + delay
+            self._entries[watcher] = due, entry
+            heapq.heappush(self._heap, (due, entry, watcher))
+
+            if not self._threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._run)
+                    thread.name = '{}-{}'.format(self.__class__.__name__, i)
+                    thread.daemon = True
+                    self._threads.append(thread)
+                    thread.start()
+
+            # A thread that is running a check cannot pick up the watcher, it
+            # will run it later.
+            if watcher not in self._running:
+                watcher.check_thread = self._threads[0]
+            self._condition.notify()
+
+    def wake(self, watcher, delay=0):
+        """Runs the next check of a scheduled watcher after delay seconds, or
+        sooner if it is already due. A watcher woken during its check is
+        scheduled again after watcher._wake_delay() seconds."""
+
+        with self._condition:
+            if watcher in self._running:
+                self._woken.add(watcher)
+            elif watcher in self._entries:
+                due = monotonic() + delay
+                if due >= self._entries[watcher][0]:
+                    return
+                entry = next(self._counter)
+                self._entries[watcher] = due, entry
+                heapq.heappush(self._heap, (due, entry, watcher))
+                self._condition.notify()
+
+    def unschedule(self, watcher):
+        """Removes a watcher from this scheduler. Waits for a running check
+        unless it is called from the check itself. Returns False if the
+        watcher was not scheduled."""
+
+        current = threading.current_thread()
+        threads = []
+
+        with self._condition:
+            result = self._entries.pop(watcher, None) is not None \
+                or watcher in self._running
+            self._woken.discard(watcher)
+
+            # Wait for the end of a check.
+            while self._running.get(watcher, current) is not current:
+                self._condition.wait()
+
+            # Nothing left to do, threads can end.
+            if not self._entries \
+               and all(i is watcher for i in self._running):
+                threads, self._threads = self._threads, []
+                self._heap = []
+                self._condition.notify_all()
+
+            # A thread is still running this check, the watcher stays alive
+            # until the check ends.
+            if watcher not in self._running:
+                watcher.check_thread = None
+
+        # Threads are stopped, wait for join them.
+        for thread in threads:
+            if thread is not current:
+                thread.join()
+        return result
+
+    def _run(self):
+        """Main loop of a scheduler thread."""
+
+        current = threading.current_thread()
+
+        with self._condition:
+            while current in self._threads:
+
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+
+                due, entry, watcher = self._heap[0]
+                if self._entries.get(watcher, (None, None))[1] != entry:
+                    heapq.heappop(self._heap)
+                    continue
+
+                delay = due - monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+
+                heapq.heappop(self._heap)
+                del self._entries[watcher]
+                self._running[watcher] = current
+                watcher.check_thread = current
+
+                self._condition.release()
+                try:
+                    watcher._prepare_check()
+                except Exception:
+                    # Same as an exception in a thread, the watcher will
+                    # not be checked anymore.
+                    traceback.print_exc()
+                finally:
+                    self._condition.acquire()
+                    del self._running[watcher]
+                    # Watcher was stopped and this thread is still working.
+                    if watcher not in self._entries and current in self._threads:
+                        watcher.check_thread = None
+                    self._condition.notify_all()
+
+
+# Scheduler used by all watchers if no other is set.
+default_scheduler = Scheduler()
+
+
+# Metrics.
+
+# Number of recent checks which metrics are kept by each watcher.
+STATS_HISTORY = 100
+
+# Upper bounds (in seconds) of buckets of a check latency histogram.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+# Counters of one check can be updated by many walking threads.
+_stats_lock = threading.Lock()
+
+
+class CheckStats:
+    """Metrics of checks: number of checks, paths scanned, directories
+    listed, stat calls, errors (directories that cannot be read), races
+    (paths deleted during a check), events run, overruns (checks longer than
+    a check interval), incomplete checks (walking continues in the next
+    check) and wall and CPU time (in seconds). CPU time is measured in
+    a check thread only, time of walking threads and worker processes is not
+    included."""
+
+    __slots__ = ('checks', 'paths', 'dirs', 'stat_calls', 'errors', 'races',
+                 'events', 'overruns', 'incomplete', 'wall_time', 'cpu_time')
+
+    def __init__(self, checks=0):
+        self.checks = checks
+        self.paths = self.dirs = self.stat_calls = 0
+        self.errors = self.races = self.events = self.overruns = 0
+        self.incomplete = 0
+        self.wall_time = self.cpu_time = 0.0
+
+    def __repr__(self):
+        args = [self.__class__.__name__]
+        args.extend(getattr(self, i) for i in self.__slots__)
+        return ("{}(checks={!r}, paths={!r}, dirs={!r}, stat_calls={!r}, "
+                "errors={!r}, races={!r}, events={!r}, overruns={!r}, "
+                "incomplete={!r}, wall_time={!r}, cpu_time={!r})") \
+            .format(*args)
+
+    def add(self, **counts):
+        """Increases counters, it is thread-safe."""
+
+        with _stats_lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def update(self, other):
+        """Adds metrics of other CheckStats."""
+        self.add(**other.as_dict())
+
+    def as_dict(self):
+        return {i: getattr(self, i) for i in self.__slots__}
+
+
+def _percentile(values, percent):
+    """Returns a percentile of a list of numbers using the nearest-rank
+    method, or None if the list is empty."""
+
+    if not values:
+        return None
+    values = sorted(values)
+    rank = -(-percent * len(values) // 100)
+    return values[max(0, min(len(values), int(rank)) - 1)]
+
+
+# Intervals.
+
+# Scheduling policies of watchers: 'fixed-delay' waits an interval after
+# each check, 'fixed-rate' starts checks each interval and skips checks
+# missed by overruns, 'jitter' starts a watcher in a random phase and
+# randomizes each delay by a jitter fraction of an interval.
+POLICIES = ('fixed-delay', 'fixed-rate', 'jitter')
+
+# Checks woken by a backend (for example by inotify events) run at most once
+# per WAKE_COST times the duration of the previous check, but at least once
+# per interval. A busy file cannot keep a scheduler thread checking all the
+# time.
+WAKE_COST = 10
+
+class AdaptiveInterval:
+    """Check interval that grows growth times after each check without
+    events, up to maximum seconds, and falls to minimum seconds after a check
+    with events. It is never shorter than cost times the duration of the last
+    check (even if it is longer than maximum), so a watcher does not spend
+    most of its time checking.
+
+    Use it instead of a number as the interval argument of watchers, each
+    watcher uses its own copy.
+    """
+
+    def __init__(self, minimum, maximum, growth=2, cost=10):
+
+        if not 0 < minimum <= maximum:
+            raise ValueError('Interval bounds must be 0 < minimum <= maximum')
+        if growth < 1:
+            raise ValueError('Growth must be at least 1')
+        if cost < 0:
+            raise ValueError('Cost must not be negative')
+
+        self.minimum = minimum
+        self.maximum = maximum
+        self.growth = growth
+        self.cost = cost
+        # Interval without the cost limit.
+        self.value = minimum
+
+    def __repr__(self):
+        args = (self.__class__.__name__, self.minimum, self.maximum,
+                self.growth, self.cost)
+        return "{}(minimum={!r}, maximum={!r}, growth={!r}, cost={!r})" \
+            .format(*args)
+
+    def update(self, changed, duration):
+        """Returns the next interval after a check that took duration
+        seconds, changed is True if the check found changes."""
+
+        if changed:
+            self.value = self.minimum
+        else:
+            self.value = min(self.maximum, self.value * self.growth)
+        return max(self.value, self.cost * duration)
 
 
 class BaseWatcher:
-    """Base watcher class. All other watcher should inherit from this class."""
+    """Base watcher class. All other watcher should inherit from this class.
+
+    Argument policy is a scheduling policy, see POLICIES. Argument jitter is
+    a fraction of an interval (from 0 to 1) used by the 'jitter' policy.
+    Checks are run by a scheduler, the shared one by default, see Scheduler.
+    """
+
+    def __init__(self, interval, policy='fixed-delay', jitter=0.1,
+                 scheduler=None):
 
-    def __init__(self, interval):
+        if policy not in POLICIES:
+            raise ValueError('Unknown scheduling policy: {!r}'.format(policy))
+        if not 0 <= jitter <= 1:
+            raise ValueError('Jitter must be between 0 and 1')
 
         self._is_alive = False
         self.lock = threading.Lock()
         self.check_thread = None
-        # Amount of time (in seconds) between running polling methods.
+        # Amount of time (in seconds) between running polling methods. It is
+        # changed after each check if an AdaptiveInterval is used.
+        self.adaptive = None
+        if isinstance(interval, AdaptiveInterval):
+            # Each watcher adapts its own copy, one instance can be passed
+            # to many watchers.
+            self.adaptive = copy.copy(interval)
+            interval = interval.value
         self.interval = interval
+        # Scheduler that runs check() in background, see start().
+        self.scheduler = default_scheduler if scheduler is None else scheduler
+        # Scheduling policy, see POLICIES.
+        self.policy = policy
+        self.jitter = jitter
+        # Time when the next check is due.
+        self._due = None
+        # Set when the first walk of a watched tree is finished. Lazy
+        # watchers walk during the first check instead of in a constructor.
+        self.ready = threading.Event()
+
+        # Metrics of all checks, recent checks and a running one.
+        self._totals = CheckStats()
+        self.history = deque(maxlen=STATS_HISTORY)
+        # Number of checks in each of LATENCY_BUCKETS, the last one counts
+        # longer checks.
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self._stats = None
+        self._check_hook = None
+        # The earliest time of a check woken by a backend, see WAKE_COST.
+        self._wake_at = 0
 
     @property
     def is_alive(self):
@@ -47,14 +385,90 @@ class BaseWatcher:
         Attribute self.interval sets how often it is executed."""
         pass
 
+    def _measure(self, function, *args):
+        """Runs function(*args) as a check and records its metrics, see
+        stats(). Returns a result of the function."""
+
+        self._stats = stats = CheckStats(1)
+        wall, cpu = monotonic(), time.thread_time()
+        try:
+            result = function(*args)
+        finally:
+            self._stats = None
+            stats.wall_time = monotonic() - wall
+            stats.cpu_time = time.thread_time() - cpu
+            stats.overruns = int(stats.wall_time > self.interval)
+            self._totals.update(stats)
+            self.latency[bisect.bisect_left(LATENCY_BUCKETS,
+                                            stats.wall_time)] += 1
+            if self.adaptive is not None:
+                self.interval = self.adaptive.update(stats.events > 0,
+                                                     stats.wall_time)
+            self.history.append(stats)
+            self._wake_at = monotonic() + min(self.interval,
+                                              WAKE_COST * stats.wall_time)
+
+        self.on_check(stats)
+        return result
+
+    def stats(self):
+        """Returns CheckStats with sums of metrics of all checks. Metrics of
+        recent checks are in the history attribute."""
+
+        x = CheckStats()
+        x.update(self._totals)
+        return x
+
+    def on_check(self, stats, *args, **kwargs):
+        """Runs after each check with its CheckStats. Use on_check(callable,
+        *args, **kwargs) to register a callable that gets them as the first
+        argument."""
+
+        if callable(stats):
+            self._check_hook = stats, args, kwargs
+        elif self._check_hook is not None:
+            function, args, kwargs = self._check_hook
+            function(stats, *args, **kwargs)
+
     def _prepare_check(self):
-        """This method is run in the Timer thread and it triggers check() method."""
+        """This method is run by the scheduler and it triggers check() method."""
 
         self.check()
-        self._start_timer_thread()
+        self._schedule_check()
 
-    def _start_timer_thread(self, check_interval=None):
-        """Starts new Timer thread, it will run check after time interval."""
+    def _wake(self):
+        """Runs the next check as soon as WAKE_COST allows, used by
+        backends."""
+
+        if self._is_alive:
+            self.scheduler.wake(self, self._wake_delay())
+
+    def _wake_delay(self):
+        """Returns time (in seconds) until a woken check can run."""
+        return max(0, self._wake_at - monotonic())
+
+    def _next_interval(self):
+        """Returns time (in seconds) until the next check."""
+        return self.interval
+
+    def _policy_delay(self, delay):
+        """Returns a delay of the next check changed by a scheduling
+        policy."""
+
+        if self.policy == 'fixed-rate' and self._due is not None:
+            # Checks missed by an overrun are skipped, next checks keep their
+            # phase.
+            rate = self._due + self.interval - monotonic()
+            if rate < 0:
+                rate = rate % self.interval if self.interval > 0 else 0
+            return min(delay, rate)
+
+        if self.policy == 'jitter':
+            return delay * (1 + random.uniform(-self.jitter, self.jitter))
+        return delay
+
+    def _schedule_check(self, check_interval=None):
+        """Schedules next check after time interval."""
 
         # Lock pauses stop() method.
         # Check if the watcher is alive because stop() can kill it during
@@ -63,22 +477,30 @@ class BaseWatcher:
             if self._is_alive:
 
                 if check_interval is None:
-                    check_interval = self.interval
+                    check_interval = self._policy_delay(self._next_interval())
+                self._due = monotonic() + check_interval
+                self.scheduler.schedule(self, check_interval)
 
-                self.check_thread = threading.Timer(check_interval,
-                                                    self._prepare_check)
-                self.check_thread.name = repr(self)
-                self.check_thread.daemon = True
-                self.check_thread.start()
+    def start(self, delay=None):
+        """Starts watching, the first check runs after delay seconds. Returns
+        False if the watcher is already started.
 
-    def start(self):
-        """Starts watching. Returns False if the watcher is already started."""
+        Watchers with the 'jitter' policy start after a random delay shorter
+        than an interval by default, others start at once."""
 
+        if self.policy not in POLICIES:
+            raise ValueError('Unknown scheduling policy: {!r}'.format(
+                self.policy))
         if self._is_alive:
             return False
 
+        if delay is None:
+            delay = 0
+            if self.policy == 'jitter':
+                delay = random.uniform(0, self.interval)
+
         self._is_alive = True
-        self._start_timer_thread(0)
+        self._schedule_check(delay)
         return True
 
     def stop(self):
@@ -86,156 +508,2623 @@ class BaseWatcher:
 
         if self._is_alive:
 
-            # Lock prevents starting new Timer threads.
+            # Lock prevents scheduling new checks.
             with self.lock:
                 self._is_alive = False
-                self.check_thread.cancel()
 
-            # Timer thread canceled, wait for join it.
-            if threading.current_thread() != self.check_thread:
-                self.check_thread.join()
-            return True
+            # Removes next check and waits for a running one.
+            self.scheduler.unschedule(self)
+            return True
+
+        # Watcher already stopped.
+        else:
+            return False
+
+
+# Filters.
+
+class _Prune:
+    """Type of PRUNE, it is false like any ignored path."""
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return 'PRUNE'
+
+    def __reduce__(self):
+        # Stays the same object in worker processes.
+        return 'PRUNE'
+
+
+# Filter returns PRUNE to ignore a directory together with everything inside
+# it, walking does not enter the directory at all.
+PRUNE = _Prune()
+
+
+def _translate(pattern):
+    """Returns a regular expression of a glob pattern. Wildcards '*' and '?'
+    do not match '/', '**' matches everything and '**/' matches zero or more
+    directories."""
+
+    result = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            result.append('(?:.*/)?')
+            i += 2
+        elif pattern.startswith('**', i):
+            result.append('.*')
+            i += 1
+        elif c == '*':
+            result.append('[^/]*')
+        elif c == '?':
+            result.append('[^/]')
+        elif c == '[' and pattern.find(']', i + 2) != -1:
+            end = pattern.find(']', i + 2)
+            x = pattern[i + 1:end].replace('\\', '\\\\')
+            if x.startswith('!'):
+                x = '^' + x[1:]
+            result.append('[' + x + ']')
+            i = end
+        else:
+            result.append(re.escape(c))
+        i += 1
+    return ''.join(result)
+
+
+class Filter:
+    """Filter compiled from glob patterns and regular expressions.
+
+    A path is accepted if it matches an include pattern (or no include
+    patterns are given) and does not match any exclude pattern. Excluded
+    paths are pruned: walking never enters excluded directories.
+
+    Patterns match a path relative to root, watchers use their own copy of
+    a filter without root with root set to their path. Glob patterns match
+    the last components of a path, for example '*.py', '.git' or
+    'build/*.o'. Regular expressions are searched in a whole path. Paths are
+    matched with '/' as a separator on all systems. Glob patterns of one
+    kind are compiled into one regular expression, regular expressions are
+    compiled separately, so their inline flags apply only to them.
+    """
+
+    def __init__(self, include=(), exclude=(), include_regex=(),
+                 exclude_regex=(), root=None):
+
+        self.include = self._compile(include, include_regex)
+        self.exclude = self._compile(exclude, exclude_regex)
+        self.root = None if root is None else os.path.abspath(root)
+
+    def __repr__(self):
+        args = (self.__class__.__name__,
+                [i.pattern for i in self.include],
+                [i.pattern for i in self.exclude], self.root)
+        return "{}(include={!r}, exclude={!r}, root={!r})".format(*args)
+
+    @staticmethod
+    def _compile(globs, regexes):
+        """Returns a list of compiled regular expressions."""
+
+        if isinstance(globs, str):
+            globs = [globs]
+        if isinstance(regexes, str):
+            regexes = [regexes]
+
+        x = ['(?:^|/)' + _translate(i.strip('/')) + r'\Z' for i in globs]
+        result = [re.compile('|'.join(x))] if x else []
+        return result + [re.compile(i) for i in regexes]
+
+    def bind(self, root):
+        """Returns a copy of this filter that matches paths relative to root,
+        or this filter if it has a root already."""
+
+        if self.root is not None:
+            return self
+        x = copy.copy(self)
+        x.root = os.path.abspath(root)
+        return x
+
+    def __call__(self, path):
+
+        if self.root is not None:
+            prefix = _prefix(self.root)
+            if path.startswith(prefix):
+                path = path[len(prefix):]
+        if os.sep != '/':
+            path = path.replace(os.sep, '/')
+        if any(i.search(path) for i in self.exclude):
+            return PRUNE
+        return not self.include or any(i.search(path) for i in self.include)
+
+
+# Walking.
+
+class _DirEntry:
+    """Used instead of os.DirEntry if a listing of a directory is already
+    known."""
+
+    def __init__(self, root, name, symlink=None):
+        self.name = name
+        self.path = os.path.join(root, name)
+        self._symlink = symlink
+
+    def stat(self):
+        return os.stat(self.path)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_symlink(self):
+        if self._symlink is None:
+            return os.path.islink(self.path)
+        return self._symlink
+
+
+def scandir(path):
+    """Returns a list of os.DirEntry instances of entries in a directory."""
+    return list(os.scandir(path))
+
+
+def _prefix(path):
+    """Returns a prefix of all paths inside a directory."""
+    return path.rstrip(os.sep) + os.sep
+
+
+# A directory modified less than RACY_TIME seconds before it was listed can
+# be modified again without changing its mtime (timestamps have limited
+# precision), so it is listed again.
+RACY_TIME = 2
+
+
+def _listing(root, stat, listings):
+    """Returns entries of a directory and True if it was listed. Listing is
+    reused if mtime of the directory has not changed, because mtime changes
+    when entries are added, removed or renamed. A directory replaced by
+    another one (with the same mtime) is found by its inode."""
+
+    mtime = stat.st_dev, stat.st_ino, stat.st_mtime_ns
+    x = listings.get(root)
+    if x is not None and x[0] == mtime and stat.st_mtime < x[1] - RACY_TIME:
+        return [_DirEntry(root, name, symlink) for name, symlink in x[2]], \
+            False
+
+    listed = time.time()
+    entries = scandir(root)
+    listings[root] = mtime, listed, [(i.name, i.is_symlink()) for i in entries]
+    return entries, True
+
+
+def _read_directory(root, stat, recursive, listings, stats=None):
+    """Returns a list of (path, os.stat_result, True if walking should enter
+    it) tuples of entries in a directory. Returns None if a directory cannot
+    be read. Metrics are added to stats (CheckStats) if it is given."""
+
+    stat_calls = races = 0
+    try:
+        if listings is None:
+            entries = scandir(root)
+            listed = True
+        else:
+            if stat is None:
+                stat_calls += 1
+                stat = os.stat(root)
+            entries, listed = _listing(root, stat, listings)
+    # Directory was deleted or it cannot be read.
+    except (IOError, OSError) as e:
+        if stats is not None:
+            if e.errno == errno.ENOENT:
+                stats.add(stat_calls=stat_calls, races=1)
+            else:
+                stats.add(stat_calls=stat_calls, errors=1)
+        return None
+
+    result = []
+    for entry in entries:
+        stat_calls += 1
+        try:
+            stat = entry.stat()
+        # A path could be deleted during walking.
+        except (IOError, OSError):
+            races += 1
+            continue
+
+        result.append((
+            entry.path, stat,
+            recursive and S_ISDIR(stat.st_mode) and not entry.is_symlink()
+        ))
+
+    if stats is not None:
+        stats.add(paths=len(result), dirs=int(listed), stat_calls=stat_calls,
+                  races=races)
+    return result
+
+
+def walk(path, recursive=False, filter=None, listings=None, executor=None,
+         stats=None, ahead=None, on_directory=None, pauses=False):
+    """Yields (path, os.stat_result) tuples of all paths inside a directory,
+    filtered using a filter callable.
+
+    Each path costs exactly one stat call, types of entries are taken from a
+    directory listing. Paths deleted during walking are skipped. Symlinks to
+    directories are not followed, same as in os.walk().
+
+    If listings dict is given, it stores listings of directories and only
+    directories with a changed mtime are listed again. Directories that are
+    not found anymore are removed from it after walking.
+
+    If executor (concurrent.futures.Executor) is given, directories are read
+    by its threads, at most ahead directories (by default twice the number
+    of its workers) before they are needed. Paths are yielded in the same
+    order and a filter is called only by the calling thread. Directories not
+    read yet are cancelled if walking is not finished.
+
+    Directories for which a filter returns PRUNE are not entered.
+
+    Metrics of walking are added to stats (CheckStats) if it is given.
+    Callable on_directory(path) is called by the calling thread when walking
+    enters a directory, unlike stats it does not count read ahead ones.
+
+    If pauses is True, None is yielded before walking enters each directory
+    but the first one, so walking can be stopped between directories and
+    continued later.
+    """
+
+    if executor is not None and ahead is None:
+        ahead = 2 * getattr(executor, '_max_workers', os.cpu_count() or 1)
+
+    # Directory path, its stat if it is known and a future with its entries
+    # if it is read by the executor.
+    stack = [(path, None, None)]
+    # Number of futures in the stack.
+    running = 0
+    seen = set()
+
+    try:
+        while stack:
+            if pauses and seen:
+                yield None
+
+            # Next directories are read in advance.
+            if executor is not None and running < ahead:
+                for i in range(len(stack) - 1, -1, -1):
+                    root, stat, future = stack[i]
+                    if future is None:
+                        stack[i] = root, stat, executor.submit(
+                            _read_directory, root, stat, recursive, listings,
+                            stats)
+                        running += 1
+                    if running >= ahead:
+                        break
+
+            root, stat, future = stack.pop()
+            if future is None:
+                entries = _read_directory(root, stat, recursive, listings,
+                                          stats)
+            else:
+                running -= 1
+                entries = future.result()
+            if entries is None:
+                continue
+            seen.add(root)
+            if on_directory is not None:
+                on_directory(root)
+
+            dirs = []
+            for p, stat, is_dir in entries:
+                x = True if filter is None else filter(p)
+                if is_dir and x is not PRUNE:
+                    dirs.append((p, stat, None))
+                if x:
+                    yield p, stat
+
+            # Same order as os.walk().
+            stack.extend(reversed(dirs))
+
+        if listings is not None:
+            for i in [i for i in listings if i not in seen]:
+                del listings[i]
+
+    # Walking was abandoned.
+    finally:
+        for root, stat, future in stack:
+            if future is not None:
+                future.cancel()
+
+
+# Inotify.
+
+# Inotify constants, see: man 7 inotify
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Events that change a list of paths.
+IN_STRUCTURE = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE \
+    | IN_DELETE_SELF | IN_MOVE_SELF
+# Events watched in each directory.
+IN_WATCHED = IN_MODIFY | IN_ATTRIB | IN_STRUCTURE | IN_ONLYDIR
+
+
+def _link_signature(path):
+    """Returns a tuple used to check if a target of a symlink was modified or
+    None if a target does not exist."""
+
+    try:
+        stat = os.stat(path)
+    except (IOError, OSError):
+        return None
+    return stat.st_mode, stat.st_uid, stat.st_gid, stat.st_mtime_ns, \
+        stat.st_size
+
+
+class Inotify:
+    """Linux inotify instance used by all InotifyBackend instances.
+
+    Uses libc through ctypes. One instance is shared by the whole process,
+    because the kernel limits a number of instances per user (usually 128).
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    # struct inotify_event: wd, mask, cookie, len
+    EVENT = struct.Struct('iIII')
+
+    @classmethod
+    def get(cls):
+        """Returns the shared instance or None if inotify is not available."""
+
+        with cls._instance_lock:
+            if cls._instance is None and sys.platform.startswith('linux'):
+                try:
+                    cls._instance = cls()
+                except (ImportError, AttributeError, OSError):
+                    pass
+            return cls._instance
+
+    def __init__(self):
+
+        import ctypes
+        import ctypes.util
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                 use_errno=True)
+        self._get_errno = ctypes.get_errno
+
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise_error()
+
+        self.lock = threading.RLock()
+        # Watch descriptor -> {backend: path of watched directory}
+        self._watches = {}
+
+        # Thread that wakes up watchers when events are waiting.
+        self._thread = threading.Thread(target=self._run)
+        self._thread.name = self.__class__.__name__
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _raise_error(self):
+        e = self._get_errno()
+        raise OSError(e, os.strerror(e))
+
+    def add_watch(self, backend, path):
+        """Watches a directory. Returns a watch descriptor."""
+
+        with self.lock:
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                              IN_WATCHED)
+            if wd < 0:
+                self._raise_error()
+            self._watches.setdefault(wd, {})[backend] = path
+            return wd
+
+    def remove_watch(self, backend, wd):
+        """Removes a watch, only if no other backend uses it."""
+
+        with self.lock:
+            backends = self._watches.get(wd)
+            if backends is None:
+                return
+            backends.pop(backend, None)
+            if not backends:
+                del self._watches[wd]
+                # Errors are ignored, a directory could be already deleted.
+                self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """Reads all waiting events and passes them to backends. Returns a set
+        of backends that got events."""
+
+        result = set()
+
+        with self.lock:
+            while True:
+                try:
+                    data = os.read(self.fd, 65536)
+                except (IOError, OSError) as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+
+                offset = 0
+                while offset < len(data):
+                    wd, mask, cookie, length = self.EVENT.unpack_from(data,
+                                                                      offset)
+                    offset += self.EVENT.size
+                    name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                    offset += length
+
+                    # Events were lost, all backends must check everything.
+                    if mask & IN_Q_OVERFLOW:
+                        for backends in self._watches.values():
+                            for backend in backends:
+                                backend.overflow()
+                                result.add(backend)
+                        continue
+
+                    backends = self._watches.get(wd, {})
+                    for backend, path in backends.items():
+                        backend.event(wd, path, mask, name)
+                        result.add(backend)
+
+                    # Watch removed by the kernel.
+                    if mask & IN_IGNORED:
+                        self._watches.pop(wd, None)
+
+        return result
+
+    def _run(self):
+        """Main loop of the thread, waits for events."""
+
+        while True:
+            try:
+                select.select([self.fd], [], [])
+            except (IOError, OSError) as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            for backend in self.read():
+                backend.wake()
+
+
+class InotifyBackend:
+    """Uses inotify to find paths that could be changed in a watched
+    directory, so a watcher checks only them instead of the whole tree.
+
+    Each path that inotify reports is checked again using os.stat(), so
+    results are the same as from polling. Targets of symlinks are not
+    watched, symlinks are checked during each call of changes().
+    Directories pruned by a filter (see PRUNE) are not watched.
+    """
+
+    def __init__(self, inotify, path, recursive=False, callback=None,
+                 filter=None):
+
+        self.inotify = inotify
+        self.path = path
+        self.is_recursive = recursive
+        self.filter = filter
+        # Runs when events are waiting.
+        self.callback = callback
+        # False when the watched directory was deleted or moved.
+        self.is_alive = True
+
+        # Path -> True if a list of paths inside could change.
+        self._changes = {}
+        self._overflow = False
+        # Path of watched directory -> watch descriptor and back again.
+        self._dirs = {}
+        self._wds = {}
+        # Old paths of moved directories, they are watched using new paths.
+        self._moved = set()
+        # Path of symlink -> signature of its target.
+        self._links = {}
+
+    def __repr__(self):
+        args = self.__class__.__name__, self.path, self.is_recursive
+        return "{}(path={!r}, recursive={!r})".format(*args)
+
+    def start(self):
+        """Watches directories. Raises OSError if limits of inotify are
+        reached or if a watched path cannot be watched."""
+
+        self.add_tree(self.path)
+        if self.path not in self._dirs:
+            self.is_alive = False
+            raise OSError(errno.ENOENT, 'Watched path cannot be watched',
+                          self.path)
+
+    def close(self):
+        """Removes all watches."""
+
+        with self.inotify.lock:
+            for wd in self._dirs.values():
+                self.inotify.remove_watch(self, wd)
+            self._dirs = {}
+            self._wds = {}
+            self._moved = set()
+            self._links = {}
+            self.is_alive = False
+
+    def add_tree(self, path):
+        """Watches a directory and in recursive mode all its subdirectories.
+        Returns a list of paths inside it."""
+
+        paths = []
+        stack = [path]
+
+        while stack:
+            root = stack.pop()
+            self._add_watch(root)
+            try:
+                entries = scandir(root)
+            except (IOError, OSError):
+                continue
+
+            for entry in entries:
+                paths.append(entry.path)
+                if entry.is_symlink():
+                    self._links[entry.path] = _link_signature(entry.path)
+                elif self.is_recursive and entry.is_dir() \
+                        and not self._is_pruned(entry.path):
+                    stack.append(entry.path)
+        return paths
+
+    def _is_pruned(self, path):
+        return self.filter is not None and self.filter(path) is PRUNE
+
+    def remove_tree(self, path):
+        """Removes watches of a directory and all its subdirectories. Returns
+        True if a directory was watched."""
+
+        # Only subdirectories of watched directories are watched.
+        if path not in self._dirs and path not in self._moved:
+            return False
+
+        prefix = path + os.sep
+        self._moved = {i for i in self._moved
+                       if i != path and not i.startswith(prefix)}
+
+        with self.inotify.lock:
+            for i in [i for i in self._dirs if i.startswith(prefix)
+                      or i == path]:
+                wd = self._dirs.pop(i)
+                # Moved directory is watched again using its new path.
+                if self._wds.get(wd) == i:
+                    del self._wds[wd]
+                    self.inotify.remove_watch(self, wd)
+        for i in [i for i in self._links if i.startswith(prefix)]:
+            del self._links[i]
+        return True
+
+    def rewatch(self, path):
+        """Updates watches of a created, deleted or moved path. Returns a
+        tuple: True if a path was watched before and a list of paths inside
+        it."""
+
+        result = self.remove_tree(path)
+        if os.path.isdir(path) and not os.path.islink(path) \
+                and not self._is_pruned(path):
+            return result, self.add_tree(path)
+        return result, []
+
+    def _add_watch(self, path):
+
+        # Events of the descriptor are read by other threads meanwhile.
+        with self.inotify.lock:
+            try:
+                wd = self.inotify.add_watch(self, path)
+            except (IOError, OSError) as e:
+                # Directory was deleted or cannot be read, os.walk() skips it
+                # too.
+                if e.errno not in (errno.ENOENT, errno.EACCES, errno.ENOTDIR):
+                    raise
+                return
+
+            # Kernel returns the same descriptor for a moved directory, an old
+            # path is not valid anymore.
+            old = self._wds.get(wd)
+            if old is not None and old != path:
+                self._dirs.pop(old, None)
+                self._moved.add(old)
+            self._dirs[path] = wd
+            self._wds[wd] = path
+
+    def event(self, wd, path, mask, name):
+        """Runs by Inotify for each event of watched directory."""
+
+        if mask & IN_IGNORED:
+            if self._dirs.get(path) == wd:
+                del self._dirs[path]
+                del self._wds[wd]
+                if path == self.path:
+                    self.is_alive = False
+        elif name:
+            path = os.path.join(path, name)
+            self._changes[path] = self._changes.get(path, False) \
+                or bool(mask & IN_STRUCTURE)
+        # Subdirectories are reported by events of their parents.
+        elif path == self.path:
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.is_alive = False
+        else:
+            self._changes.setdefault(path, False)
+
+    def overflow(self):
+        """Runs by Inotify when events were lost."""
+        self._overflow = True
+
+    def defer(self, changes):
+        """Returns changes (see changes()) by the next call again."""
+
+        with self.inotify.lock:
+            for path, structural in changes.items():
+                self._changes[path] = self._changes.get(path, False) \
+                    or structural
+
+    def wake(self):
+        """Runs by Inotify when events are waiting."""
+
+        if self.callback:
+            self.callback()
+
+    def changes(self):
+        """Returns a dict with paths that could be changed since the last
+        call, values are True if a list of paths inside could change too.
+        Returns None if all paths must be checked."""
+
+        self.inotify.read()
+        with self.inotify.lock:
+            changes, self._changes = self._changes, {}
+            overflow, self._overflow = self._overflow, False
+
+        # Targets of symlinks are not watched.
+        for path, signature in list(self._links.items()):
+            x = _link_signature(path)
+            if x != signature:
+                changes.setdefault(path, False)
+                if x is None and not os.path.islink(path):
+                    del self._links[path]
+                else:
+                    self._links[path] = x
+        for path in changes:
+            if path not in self._links and os.path.islink(path):
+                self._links[path] = _link_signature(path)
+
+        return None if overflow else changes
+
+
+def _inotify_backend(watcher):
+    """Returns a started InotifyBackend for a watcher or None if inotify is
+    not available or its limits are reached."""
+
+    inotify = Inotify.get()
+    if inotify is None:
+        return None
+
+    # Backend should not keep a watcher alive.
+    ref = weakref.ref(watcher)
+    def wake():
+        x = ref()
+        if x is not None:
+            x._wake()
+
+    backend = InotifyBackend(inotify, watcher.path, watcher.is_recursive, wake,
+                             watcher.filter)
+    try:
+        backend.start()
+    except (IOError, OSError):
+        backend.close()
+        return None
+
+    weakref.finalize(watcher, backend.close)
+    return backend
+
+
+# Digests.
+
+def _record(name, stat):
+    """Returns a record of a directory entry used to compute a digest."""
+
+    # Directories.
+    if S_ISDIR(stat.st_mode):
+        return name, 0, stat.st_mode, stat.st_uid, stat.st_gid
+    # Files.
+    return name, 0, stat.st_mode, stat.st_uid, stat.st_gid, \
+        stat.st_mtime_ns, stat.st_size
+
+
+def _digest(records):
+    """Returns a digest of sorted records."""
+
+    records.sort()
+    return hashlib.sha1(repr(records).encode()).digest()
+
+
+def digests(path, recursive=False, filter=None, executor=None, stats=None,
+            cache=None):
+    """Returns dict with digests of directories in a path location.
+
+    Digest of a directory is computed from stats of its entries and digests
+    of its subdirectories, so only one digest per directory is stored.
+    Directories are closed as soon as walking leaves them. Subdirectories
+    without paths accepted by a filter have no digest.
+
+    If cache dict is given, it keeps a quick hash of records of each
+    directory together with its digest, so a digest is computed again only
+    if records of a directory change.
+    """
+
+    snapshot = {}
+    # Open directories with records of their entries.
+    stack = [(path, [])]
+
+    def close():
+        path, records = stack.pop()
+        if cache is None:
+            digest = _digest(records)
+        else:
+            records.sort()
+            key = hash(tuple(records))
+            x = cache.get(path)
+            if x is not None and x[0] == key:
+                digest = x[1]
+            else:
+                digest = _digest(records)
+                cache[path] = key, digest
+        snapshot[path] = digest
+        if stack:
+            stack[-1][1].append((os.path.basename(path), 1, digest))
+
+    for p, stat in walk(path, recursive, filter, executor=executor,
+                        stats=stats):
+        root, name = os.path.split(p)
+
+        # Walking left directories.
+        while stack[-1][0] != root \
+                and not root.startswith(_prefix(stack[-1][0])):
+            close()
+
+        # Directories without records (ignored by a filter).
+        if stack[-1][0] != root:
+            missing = []
+            while root != stack[-1][0]:
+                missing.append(root)
+                root = os.path.dirname(root)
+            stack.extend((i, []) for i in reversed(missing))
+
+        stack[-1][1].append(_record(name, stat))
+
+    while stack:
+        close()
+    if cache is not None:
+        for i in [i for i in cache if i not in snapshot]:
+            del cache[i]
+    return snapshot
+
+
+# Hashing.
+
+# Files of at least this size are hashed using mmap, smaller ones are read in
+# chunks of this size.
+MMAP_SIZE = 1 << 20
+
+
+def hash_file(path):
+    """Returns a SHA-1 digest of a file content, or None if a file cannot be
+    read."""
+
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size >= MMAP_SIZE:
+                with mmap.mmap(file.fileno(), 0,
+                               access=mmap.ACCESS_READ) as data:
+                    digest.update(data)
+            else:
+                for chunk in iter(lambda: file.read(MMAP_SIZE), b''):
+                    digest.update(chunk)
+    # Mmap raises ValueError if a file was truncated meanwhile.
+    except (IOError, OSError, ValueError):
+        return None
+    return digest.digest()
+
+
+class HashCache:
+    """Digests of contents of files. A digest is stored together with an
+    inode, size and mtime of a file, the file is read again only if they or
+    its ctime change, or if it is racily clean (modified less than RACY_TIME
+    seconds before it was hashed, so it could change without a new mtime).
+    """
+
+    def __init__(self):
+        # Path -> (inode, size, mtime), ctime, time of hashing, digest.
+        self._entries = {}
+
+    def __repr__(self):
+        args = self.__class__.__name__, len(self._entries)
+        return "{}(files={!r})".format(*args)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def update(self, path, stat):
+        """Hashes a file. Returns its digest or None if it cannot be read."""
+
+        hashed = time.time()
+        digest = hash_file(path)
+        self._entries[path] = (stat.st_ino, stat.st_size, stat.st_mtime_ns), \
+            stat.st_ctime_ns, hashed, digest
+        return digest
+
+    def is_modified(self, path, stat):
+        """Returns True if content of a file has changed since it was hashed.
+        A file that is hashed for the first time is not modified."""
+
+        x = self._entries.get(path)
+        if x is None:
+            self.update(path, stat)
+            return False
+
+        key, ctime, hashed, digest = x
+        if key == (stat.st_ino, stat.st_size, stat.st_mtime_ns) \
+                and ctime == stat.st_ctime_ns \
+                and stat.st_mtime < hashed - RACY_TIME:
+            return False
+
+        new = self.update(path, stat)
+        return None not in (digest, new) and digest != new
+
+    def discard(self, path):
+        self._entries.pop(path, None)
+
+
+# Processes.
+
+# Errors after which watchers stop using worker processes.
+_POOL_ERRORS = (concurrent.futures.process.BrokenProcessPool, OSError)
+
+# Digest of a directory without records.
+_EMPTY_DIGEST = _digest([])
+
+# State of shards scanned by a worker process: path of a shard -> dict with
+# records of paths and listings of directories.
+_shards = {}
+
+
+def _scan_shard(path, incremental, filter=None):
+    """Walks a shard in a worker process. Returns a list of (path,
+    os.stat_result) tuples of created or modified paths, a list of deleted
+    paths since the previous call and CheckStats of walking."""
+
+    old, listings = _shards.pop(path, ({}, {} if incremental else None))
+    new = {}
+    changed = []
+    stats = CheckStats()
+
+    for p, stat in walk(path, True, filter, listings, stats=stats):
+        if S_ISDIR(stat.st_mode):
+            x = True, stat.st_mode, stat.st_uid, stat.st_gid
+        else:
+            x = False, stat.st_mode, stat.st_uid, stat.st_gid, \
+                stat.st_mtime_ns, stat.st_size
+        if old.pop(p, None) != x:
+            changed.append((p, stat))
+        new[p] = x
+
+    # State of deleted shards is forgotten.
+    if os.path.isdir(path):
+        _shards[path] = new, listings
+    return changed, list(old), stats
+
+
+def _digest_shard(path, filter):
+    """Returns digests of directories in a shard, computed in a worker
+    process, and CheckStats of walking."""
+
+    stats = CheckStats()
+    x = digests(path, True, filter, stats=stats)
+    if x == {path: _EMPTY_DIGEST}:
+        return {}, stats
+    return x, stats
+
+
+class ProcessPool:
+    """Worker processes that scan subdirectories (shards) of a watched
+    directory, each shard is a directory in the watched one.
+
+    Each shard is always scanned by the same process, so the process keeps
+    records of its paths and returns only differences. Comparing paths is
+    done outside of the main process, checks scale with number of cores.
+    """
+
+    def __init__(self, processes):
+
+        # Forking a process with running threads is not safe.
+        context = multiprocessing.get_context('spawn')
+        self.executors = [
+            concurrent.futures.ProcessPoolExecutor(1, mp_context=context)
+            for i in range(processes)]
+
+        # Path of a shard -> executor that scans it.
+        self.shards = {}
+        self._counter = itertools.count()
+
+    def __repr__(self):
+        args = self.__class__.__name__, len(self.executors), len(self.shards)
+        return "{}(processes={!r}, shards={!r})".format(*args)
+
+    def shutdown(self, wait=True):
+        for i in self.executors:
+            i.shutdown(wait)
+
+    def submit(self, shard, function, *args):
+        """Runs function(shard, *args) in a process assigned to the shard."""
+
+        if shard not in self.shards:
+            x = self.executors[next(self._counter) % len(self.executors)]
+            self.shards[shard] = x
+        return self.shards[shard].submit(function, shard, *args)
+
+    def scan(self, root, entries, incremental=False, filter=None):
+        """Scans shards of a root directory. Argument entries is a list of
+        (path, os.stat_result, True if a path is a shard) tuples of entries in
+        a root directory. Yields results of _scan_shard() in order of
+        entries, deleted shards are the last."""
+
+        shards = [i[0] for i in entries if i[2]]
+        deleted = [i for i in self.shards if i not in set(shards)]
+
+        futures = [self.submit(i, _scan_shard, incremental, filter)
+                   for i in shards + deleted]
+        for i in deleted:
+            del self.shards[i]
+        for i in futures:
+            yield i.result()
+
+    def digests(self, root, filter=None, stats=None):
+        """Returns the same result as digests(root, True, filter), but
+        subdirectories of a root are computed by processes."""
+
+        entries = _read_directory(root, None, True, None, stats) or []
+        futures = [(p, self.submit(p, _digest_shard, filter))
+                   for p, stat, is_dir in entries
+                   if is_dir and (filter is None or filter(p) is not PRUNE)]
+        for i in set(self.shards) - {p for p, future in futures}:
+            del self.shards[i]
+
+        snapshot = {}
+        records = [_record(os.path.basename(p), stat)
+                   for p, stat, is_dir in entries
+                   if filter is None or filter(p)]
+
+        for p, future in futures:
+            x, shard_stats = future.result()
+            if stats is not None:
+                stats.update(shard_stats)
+            if x:
+                snapshot.update(x)
+                records.append((os.path.basename(p), 1, x[p]))
+
+        snapshot[root] = _digest(records)
+        return snapshot
+
+
+def _picklable(x):
+    """Returns True if x can be sent to worker processes."""
+
+    try:
+        pickle.dumps(x)
+    except Exception:
+        return False
+    return True
+
+
+def _process_pool(watcher, processes):
+    """Returns a ProcessPool used by a recursive watcher or None if processes
+    is not set. Processes are shut down together with a watcher."""
+
+    if not processes or not watcher.is_recursive:
+        return None
+    pool = ProcessPool(processes)
+    weakref.finalize(watcher, pool.shutdown, False)
+    return pool
+
+
+# Snapshots.
+
+# Snapshot file: header, root path, records and paths of records. Paths are
+# stored relative to the root path.
+SNAPSHOT_MAGIC = b'WATCHERS'
+SNAPSHOT_VERSION = 2
+# Magic, version, kind of records, number of records, length of root path.
+_SNAPSHOT_HEADER = struct.Struct('<8sBcQI')
+
+
+def _stat_result(mode, uid, gid, mtime_ns, size, dev=0, ino=0):
+    """Returns os.stat_result with fields stored in snapshots."""
+
+    mtime = mtime_ns / 1e9
+    return os.stat_result((mode, ino, dev, 0, uid, gid, size, 0, int(mtime),
+                           0, 0.0, mtime, 0.0, 0, mtime_ns, 0))
+
+
+def _save_snapshot(filename, kind, root, record, items):
+    """Writes a snapshot file. Argument record is a struct format of a record
+    (without an offset and a length of its path), items are tuples with a
+    path and values of a record."""
+
+    record = struct.Struct('<QI' + record)
+    prefix = _prefix(root)
+    records = bytearray()
+    paths = bytearray()
+
+    for path, values in items:
+        x = os.fsencode(path[len(prefix):] if path != root else '')
+        records += record.pack(len(paths), len(x), *values)
+        paths += x
+
+    x = os.fsencode(root)
+    header = _SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, kind,
+                                   len(records) // record.size, len(x))
+
+    # File is replaced at once, it is never half written.
+    temp = filename + '.tmp'
+    with open(temp, 'wb') as file:
+        file.write(header + x)
+        file.write(records)
+        file.write(paths)
+    os.replace(temp, filename)
+
+
+def _load_snapshot(filename, kind, root, record):
+    """Returns a list of (path, values) tuples from a memory-mapped snapshot
+    file. Raises ValueError if a file is not a snapshot of the root path."""
+
+    record = struct.Struct('<QI' + record)
+
+    with open(filename, 'rb') as file:
+        if os.fstat(file.fileno()).st_size < _SNAPSHOT_HEADER.size:
+            raise ValueError('Not a snapshot file: {!r}'.format(filename))
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, x, count, length = \
+                _SNAPSHOT_HEADER.unpack_from(data)
+            offset = _SNAPSHOT_HEADER.size + length
+
+            if (magic, version, x) != (SNAPSHOT_MAGIC, SNAPSHOT_VERSION, kind) \
+               or len(data) < offset + count * record.size:
+                raise ValueError('Not a snapshot file: {!r}'.format(filename))
+            if os.fsdecode(data[_SNAPSHOT_HEADER.size:offset]) != root:
+                raise ValueError('Snapshot of a different path: {!r}'.format(
+                    filename))
+
+            items = []
+            paths = offset + count * record.size
+            for i in range(count):
+                values = record.unpack_from(data, offset)
+                offset += record.size
+                start = paths + values[0]
+                path = os.fsdecode(data[start:start + values[1]])
+                items.append((os.path.join(root, path) if path else root,
+                              values[2:]))
+            return items
+
+
+# Budgets.
+
+class TokenBucket:
+    """Limits a rate of I/O operations (stat calls) to rate per second, with
+    bursts of up to burst operations. Operations are charged after they are
+    done, so a bucket can get into a debt that is paid by waiting. It can be
+    shared by many watchers, it is thread-safe."""
+
+    def __init__(self, rate, burst=None):
+
+        if rate <= 0:
+            raise ValueError('Rate must be positive')
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        if self.burst <= 0:
+            raise ValueError('Burst must be positive')
+
+        self._tokens = self.burst
+        self._time = monotonic()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        args = self.__class__.__name__, self.rate, self.burst
+        return "{}(rate={!r}, burst={!r})".format(*args)
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._time) * self.rate)
+        self._time = now
+
+    def charge(self, count):
+        """Takes count tokens, even if there are not enough of them."""
+
+        with self._lock:
+            self._refill()
+            self._tokens -= count
+
+    def available(self):
+        """Returns a number of tokens, negative if a bucket is in debt."""
+
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def delay(self):
+        """Returns time (in seconds) until a bucket is full."""
+
+        with self._lock:
+            self._refill()
+            return (self.burst - self._tokens) / self.rate
+
+
+# Dispatching.
+
+class Dispatcher:
+    """Runs event callbacks outside of check threads, so slow callbacks do
+    not delay checks. One dispatcher can be shared by many watchers.
+
+    Events wait in a queue of at most maxsize events. Policy sets what
+    happens when the queue is full: 'block' waits for a free place, 'drop'
+    removes the oldest event and 'coalesce' merges an event into the newest
+    waiting one with the same key (events of a watcher are merged like
+    debounced ones), it waits only if there is no such event.
+
+    Callbacks run in an executor (concurrent.futures.Executor), by default
+    in a thread pool. At most workers callbacks run at once, with more than
+    one worker callbacks can end in any order.
+    """
+
+    POLICIES = 'block', 'drop', 'coalesce'
+
+    def __init__(self, maxsize=1000, policy='block', workers=1, executor=None):
+
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown policy: {!r}'.format(policy))
+        if maxsize < 1:
+            raise ValueError('Queue size must be positive')
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.workers = workers
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(
+            workers)
+        # Number of events removed by the 'drop' policy.
+        self.dropped = 0
+
+        # Number -> (key, function, args, kwargs) of waiting events, oldest
+        # first.
+        self._queue = OrderedDict()
+        # Key -> number of the newest waiting event with this key, used by
+        # the 'coalesce' policy.
+        self._keys = {}
+        # Number of callbacks submitted to the executor and not finished.
+        self._running = 0
+        # Thread that submits events, it ends when the queue is empty.
+        self._thread = None
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+    def __repr__(self):
+        args = self.__class__.__name__, self.policy, len(self._queue)
+        return "{}(policy={!r}, queued={!r})".format(*args)
+
+    def put(self, key, function, args=(), kwargs=None):
+        """Queues function(*args, **kwargs). Argument key identifies events
+        replaced by the 'coalesce' policy."""
+
+        def merge(event):
+            return key, function, args, kwargs or {}
+        self._put(key, merge(None), merge)
+
+    def put_event(self, watcher, name, *items):
+        """Queues an event method of a watcher, for example on_created. The
+        'coalesce' policy merges events of the same path."""
+
+        item = items[0] if len(items) == 1 else items
+
+        def merge(event):
+            events = event[2][1]
+            _merge_event(events, name, item)
+            return event if events else None
+
+        key = watcher, items[-1].path
+        self._put(key, (key, _run_events, (watcher, [(name, item)]), {}),
+                  merge)
+
+    def _put(self, key, event, merge):
+        """Queues a (key, function, args, kwargs) event. When the queue is
+        full, the 'coalesce' policy calls merge(waiting event) and queues its
+        result as the newest event, None removes the waiting event."""
+
+        with self._condition:
+            while len(self._queue) >= self.maxsize:
+                if self.policy == 'drop':
+                    self._queue.popitem(last=False)
+                    self.dropped += 1
+                elif self.policy == 'coalesce' \
+                        and self._keys.get(key) in self._queue:
+                    number = self._keys.pop(key)
+                    x = merge(self._queue.pop(number))
+                    if x is not None:
+                        self._queue[number] = x
+                        self._keys[key] = number
+                    self._condition.notify_all()
+                    return
+                else:
+                    self._condition.wait()
+
+            number = next(self._counter)
+            self._queue[number] = event
+            if self.policy == 'coalesce':
+                self._keys[key] = number
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.name = self.__class__.__name__
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify_all()
+
+    def join(self, timeout=None):
+        """Waits until all queued callbacks are finished. Returns False on
+        timeout."""
+
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._queue and not self._running, timeout)
+
+    def _run(self):
+        """Main loop of the thread, submits events to the executor."""
+
+        with self._condition:
+            while self._queue:
+                if self._running >= self.workers:
+                    self._condition.wait()
+                    continue
+
+                number, (key, function, args, kwargs) = \
+                    self._queue.popitem(False)
+                if self._keys.get(key) == number:
+                    del self._keys[key]
+                self._running += 1
+                # Blocked put() calls can continue.
+                self._condition.notify_all()
+
+                self._condition.release()
+                try:
+                    future = self.executor.submit(function, *args, **kwargs)
+                    future.add_done_callback(self._done)
+                except Exception:
+                    traceback.print_exc()
+                    self._done(None)
+                finally:
+                    self._condition.acquire()
+
+            self._thread = None
+
+    def _done(self, future):
+
+        if future is not None and not future.cancelled() \
+                and future.exception() is not None:
+            e = future.exception()
+            traceback.print_exception(type(e), e, e.__traceback__)
+
+        with self._condition:
+            self._running -= 1
+            self._condition.notify_all()
+
+
+def _run_events(watcher, events):
+    """Runs (name, item) events of a watcher queued by a dispatcher, an item
+    of on_moved event is a (src, dst) tuple."""
+
+    for name, item in events:
+        getattr(watcher, name)(*(item if isinstance(item, tuple) else (item,)))
+
+
+# Watchers.
+
+def _merge_event(events, name, item):
+    """Merges an event of a path into a list of its pending (name, item)
+    events."""
+
+    last = events[-1][0] if events else None
+
+    if name == 'on_modified' and last in ('on_created', 'on_modified'):
+        events[-1] = last, item
+    elif name == 'on_deleted' and last == 'on_created':
+        events.pop()
+    elif name == 'on_deleted' and last == 'on_modified':
+        events[-1] = name, item
+    # Deleted and created again with the same type.
+    elif name == 'on_created' and last == 'on_deleted' \
+            and events[-1][1].is_file == item.is_file:
+        events[-1] = 'on_modified', item
+    else:
+        events.append((name, item))
+
+
+def _same_file(a, b):
+    """Returns True if items with the same inode could be the same file, an
+    inode of a deleted file can be reused by a new one."""
+
+    if a.is_file != b.is_file:
+        return False
+    if not a.is_file:
+        return True
+    return a.stat.st_mtime_ns == b.stat.st_mtime_ns \
+        and a.stat.st_size == b.stat.st_size
+
+
+def _check_backend(backend):
+    """Raises ValueError if a backend name is not known."""
+
+    if backend not in ('polling', 'inotify'):
+        raise ValueError('Unknown backend: {!r}'.format(backend))
+    return backend
+
+
+class _CheckCounter:
+    """Adds metrics to CheckStats of a running check of a watcher and charges
+    them to its budgets. Walking that continues during many checks uses it
+    instead of CheckStats of one check."""
+
+    __slots__ = 'watcher',
+
+    def __init__(self, watcher):
+        # Watchers are not kept alive by a reference cycle, their worker
+        # processes are shut down as soon as they are not used.
+        self.watcher = weakref.ref(watcher)
+
+    def add(self, **counts):
+        watcher = self.watcher()
+        if watcher is None:
+            return
+        if watcher._stats is not None:
+            watcher._stats.add(**counts)
+        if 'stat_calls' in counts:
+            for i in watcher.budgets:
+                i.charge(counts['stat_calls'])
+
+    def directory(self, path):
+        """Counts a directory entered by walking of the running check, read
+        ahead directories are not counted."""
+
+        watcher = self.watcher()
+        if watcher is not None:
+            watcher._slice_dirs += 1
+
+
+def _executor(watcher, workers):
+    """Returns a thread pool used for walking or None if workers is not set.
+    Pool is shut down together with a watcher."""
+
+    if not workers:
+        return None
+    executor = concurrent.futures.ThreadPoolExecutor(workers)
+    weakref.finalize(watcher, executor.shutdown, False)
+    return executor
+
+
+class ChangeSet:
+    """Items of created, modified and deleted paths found by one check.
+    Moved paths are (source item, destination item) tuples."""
+
+    def __init__(self):
+        self.created = []
+        self.modified = []
+        self.deleted = []
+        self.moved = []
+
+    def __repr__(self):
+        args = (self.__class__.__name__, len(self.created),
+                len(self.modified), len(self.deleted), len(self.moved))
+        return "{}(created={!r}, modified={!r}, deleted={!r}, " \
+               "moved={!r})".format(*args)
+
+    def __len__(self):
+        return len(self.created) + len(self.modified) + len(self.deleted) \
+            + len(self.moved)
+
+
+class Item:
+    """Represents a file or a directory."""
+
+    __slots__ = 'path', 'stat', 'is_file'
+
+    def __init__(self, path, stat=None):
+
+        # Path can be deleted during creating an Item instance.
+        self.path = path
+        self.stat = stat
+        if stat is None:
+            try:
+                self.stat = os.stat(path)
+            except (IOError, OSError):
+                self.path = None
+
+        self.is_file = None
+        if self.path:
+            if S_ISDIR(self.stat.st_mode):
+                self.is_file = False
+            else:
+                self.is_file = True
+
+    @property
+    def inode(self):
+        """Tuple with a device and an inode number, (0, 0) if not known."""
+        return self.stat.st_dev, self.stat.st_ino
+
+    def is_modified(self, stat=None):
+        """Returns True if a file/directory was modified. Argument stat is a
+        current os.stat() result, if it is already known."""
+
+        # Path can be deleted before this method.
+        if stat is None:
+            try:
+                stat = os.stat(self.path)
+            except (IOError, OSError):
+                return True
+
+        if not self.is_file:
+            # st_mode: File mode (permissions)
+            # st_uid: Owner id.
+            # st_gid: Group id.
+            a = self.stat.st_mode, self.stat.st_uid, self.stat.st_gid
+            b = stat.st_mode, stat.st_uid, stat.st_gid
+            if a != b:
+                self.stat = stat
+                return True
+            return False
+
+        # Check if a file is modified.
+        a = self.stat.st_mtime_ns, self.stat.st_size, self.stat.st_mode, \
+            self.stat.st_uid, self.stat.st_gid
+        b = stat.st_mtime_ns, stat.st_size, stat.st_mode, stat.st_uid, \
+            stat.st_gid
+        if a != b:
+            self.stat = stat
+            return True
+        return False
+
+
+def _split(path):
+    """Faster os.path.split() of paths built by os.path.join()."""
+
+    i = path.rfind(os.sep)
+    head = path[:i]
+    # Roots, drives and relative paths.
+    if i <= 0 or head[-1] in ':' + os.sep:
+        return os.path.split(path)
+    return head, path[i + 1:]
+
+
+class PathTable:
+    """Watched paths and their fields compared by checks: mode, uid, gid,
+    mtime in ns, size, device and inode. Fields are stored in arrays (one
+    array per field, one row per path), Items are created only on demand.
+
+    Paths are not stored as strings. Directories are nodes of a tree with
+    interned names and each node keeps a dict of names of its paths, so
+    a path costs about as much as its name, not its full length. Names that
+    repeat in many directories are stored once, unless they do not repeat
+    often enough to pay for it (see SHARED_NAMES). Full paths are built only
+    when they are needed.
+
+    Works like a dict with paths as keys and Items as values. During
+    a sweep (see mark()) each stored path is marked and sweep() removes
+    unmarked ones.
+    """
+
+    # Names and array types of fields.
+    FIELDS = ('mode', 'I'), ('uid', 'I'), ('gid', 'I'), ('mtime', 'q'), \
+        ('size', 'Q'), ('dev', 'Q'), ('ino', 'Q')
+
+    # Number of recently found directories remembered, walking leaves
+    # a directory after all paths inside are found.
+    RECENT_DIRS = 4096
+
+    # Names of paths are shared until this many distinct names are found
+    # and fewer of them are repeated, then each path keeps its own name.
+    # A shared name costs more than a name that is not repeated.
+    SHARED_NAMES = 4096
+
+    def __init__(self):
+
+        # Interned names of directories: id -> name and back again.
+        self._names = []
+        self._name_ids = {}
+        # Nodes of directories: parent node (-1 for roots) and name id of
+        # each node, (parent node + 1, name id) key -> node.
+        self._node_parents = array.array('q')
+        self._node_names = array.array('I')
+        self._nodes = {}
+
+        # Directory node -> dict with names of its paths -> rows.
+        self._entries = {}
+        self._size = 0
+        self._columns = [array.array(i) for name, i in self.FIELDS]
+        # Rows of removed paths, they are used again.
+        self._free = []
+        # Marks of rows during a sweep, None if there is no sweep.
+        self._seen = None
+
+        # Shared names of paths and a number of times they were repeated,
+        # None if names are not shared.
+        self._shared = {}
+        self._repeated = 0
+
+        # Recently found directories (path -> node), the last found directory
+        # and path, walking finds paths of one directory one after another.
+        self._recent_dirs = {}
+        self._last_dir = None, None
+        self._last_path = None, None, None
+
+    def __repr__(self):
+        args = self.__class__.__name__, len(self), len(self._node_parents)
+        return "{}(paths={!r}, dirs={!r})".format(*args)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, path):
+        entries, name = self._locate(path)
+        return entries is not None and name in entries
+
+    def __iter__(self):
+
+        # Node -> path of a directory.
+        cache = {}
+        for node, entries in list(self._entries.items()):
+            head = self._node_path(node, cache)
+            for name in list(entries):
+                yield os.path.join(head, name)
+
+    def __getitem__(self, path):
+        return Item(path, _stat_result(*self.record(path)))
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for path in self:
+            yield path, self[path]
+
+    def values(self):
+        for path in self:
+            yield self[path]
+
+    def get(self, path, default=None):
+        return self[path] if path in self else default
+
+    def _name(self, name, create):
+        """Returns an id of an interned name."""
+
+        x = self._name_ids.get(name)
+        if x is None and create:
+            x = self._name_ids[name] = len(self._names)
+            self._names.append(name)
+        return x
+
+    def _node(self, path, create=False):
+        """Returns a node of a directory or None if it is not known."""
 
-        # Watcher already stopped.
+        node = self._recent_dirs.get(path)
+        if node is not None:
+            return node
+
+        head, name = _split(path)
+        if head == path:
+            parent, name = -1, path
         else:
+            parent = self._node(head, create)
+            if parent is None:
+                return None
+
+        name = self._name(name, create)
+        if name is None:
+            return None
+        key = (parent + 1) << 32 | name
+        node = self._nodes.get(key)
+        if node is None:
+            if not create:
+                return None
+            node = self._nodes[key] = len(self._node_parents)
+            self._node_parents.append(parent)
+            self._node_names.append(name)
+
+        if len(self._recent_dirs) >= self.RECENT_DIRS:
+            self._recent_dirs.clear()
+        self._recent_dirs[path] = node
+        return node
+
+    def _locate(self, path, create=False):
+        """Returns a dict with rows of paths in the directory of a path (None
+        if it is not known) and a name of the path."""
+
+        last = self._last_path
+        if path == last[0]:
+            return last[1], last[2]
+
+        # Directory is usually the same as of the previous path.
+        head, entries = self._last_dir
+        i = path.rfind(os.sep)
+        if path[:i] != head or entries is None:
+            head = path[:i]
+            node = self._recent_dirs.get(head) if i > 0 else None
+            if node is None:
+                head, name = _split(path)
+                node = self._node(head, create)
+            entries = None if node is None else self._entries.get(node)
+            if entries is None and create:
+                entries = self._entries[node] = {}
+            self._last_dir = head, entries
+            if entries is None:
+                return None, path[i + 1:]
+
+        name = path[i + 1:]
+        self._last_path = path, entries, name
+        return entries, name
+
+    def _share(self, name):
+        """Returns a shared copy of a name of a new path, see SHARED_NAMES."""
+
+        shared = self._shared
+        if shared is None:
+            return name
+        x = shared.get(name)
+        if x is not None:
+            self._repeated += 1
+            return x
+
+        shared[name] = name
+        if len(shared) % self.SHARED_NAMES == 0 \
+                and self._repeated < len(shared):
+            self._shared = None
+        return name
+
+    def _node_path(self, node, cache=None):
+
+        x = None if cache is None else cache.get(node)
+        if x is None:
+            parent = self._node_parents[node]
+            x = self._names[self._node_names[node]]
+            if parent >= 0:
+                x = os.path.join(self._node_path(parent, cache), x)
+            if cache is not None:
+                cache[node] = x
+        return x
+
+    def under(self, path):
+        """Returns a list of stored paths inside a directory."""
+
+        node = self._node(path)
+        if node is None:
+            return []
+
+        # Nodes inside the directory.
+        inside = {node: True}
+        def is_inside(i):
+            x = inside.get(i)
+            if x is None:
+                parent = self._node_parents[i]
+                x = inside[i] = parent >= 0 and is_inside(parent)
+            return x
+
+        cache = {}
+        return [os.path.join(self._node_path(i, cache), name)
+                for i, entries in list(self._entries.items()) if is_inside(i)
+                for name in entries]
+
+    def _row(self, path):
+        """Returns a row of a path or None if it is not stored."""
+
+        entries, name = self._locate(path)
+        return None if entries is None else entries.get(name)
+
+    def record(self, path):
+        """Returns a tuple with fields of a path."""
+
+        row = self._row(path)
+        if row is None:
+            raise KeyError(path)
+        return tuple(i[row] for i in self._columns)
+
+    def is_dir(self, path):
+        """Returns True if a path is a directory, None if it is not stored."""
+
+        row = self._row(path)
+        if row is None:
+            return None
+        return S_ISDIR(self._columns[0][row])
+
+    def add(self, path, stat):
+        """Stores fields of a path from os.stat_result."""
+        self.add_record(path, (stat.st_mode, stat.st_uid, stat.st_gid,
+                               stat.st_mtime_ns, stat.st_size, stat.st_dev,
+                               stat.st_ino))
+
+    def add_record(self, path, record):
+        """Stores fields of a path from a tuple, see record()."""
+
+        entries, name = self._locate(path, True)
+        row = entries.get(name)
+        if row is None:
+            if self._free:
+                row = self._free.pop()
+            else:
+                row = len(self._columns[0])
+                for i in self._columns:
+                    i.append(0)
+            entries[self._share(name)] = row
+            self._size += 1
+
+        for column, value in zip(self._columns, record):
+            column[row] = value
+        if self._seen is not None and row < len(self._seen):
+            self._seen[row] = 1
+
+    def pop(self, path, *default):
+        """Removes a path and returns its Item."""
+
+        if default and path not in self:
+            return default[0]
+        item = self[path]
+        entries, name = self._locate(path)
+        self._free.append(entries.pop(name))
+        self._size -= 1
+        # Rows are not renumbered during a sweep.
+        if self._seen is None:
+            self._compact_unused()
+        return item
+
+    def is_modified(self, path, stat):
+        """Returns True if a stored path of the same type was modified, its
+        fields are updated then."""
+
+        modified = self.compare(path, stat)
+        # Type of a path was changed.
+        if modified is None:
+            if path not in self:
+                raise KeyError(path)
+            self.add(path, stat)
+            return True
+        return modified
+
+    def compare(self, path, stat):
+        """Returns True if a stored path was modified (its fields are updated
+        then), False if it was not or None if it is not stored with the same
+        type. Used by checks instead of is_dir() and is_modified()."""
+
+        row = self._row(path)
+        if row is None:
+            return None
+        c = self._columns
+        mode = c[0][row]
+        if S_ISDIR(mode) != S_ISDIR(stat.st_mode):
+            return None
+        seen = self._seen
+        if seen is not None and row < len(seen):
+            seen[row] = 1
+
+        if mode != stat.st_mode or c[1][row] != stat.st_uid \
+                or c[2][row] != stat.st_gid:
+            modified = True
+        # Only mode and owners of directories are compared.
+        elif S_ISDIR(mode):
             return False
+        else:
+            modified = c[3][row] != stat.st_mtime_ns \
+                or c[4][row] != stat.st_size
+        if modified:
+            self.add(path, stat)
+        return modified
+
+    def mark(self):
+        """Starts a sweep, paths stored or compared from now are marked."""
+        self._seen = bytearray(len(self._columns[0]))
+
+    def sweep(self):
+        """Removes paths not marked since mark(). Returns their Items."""
+
+        seen, self._seen = self._seen, None
+        cache = {}
+        result = []
+        for node, entries in list(self._entries.items()):
+            for name, row in list(entries.items()):
+                if row < len(seen) and not seen[row]:
+                    path = os.path.join(self._node_path(node, cache), name)
+                    result.append(Item(path, _stat_result(
+                        *(i[row] for i in self._columns))))
+                    self._free.append(entries.pop(name))
+                    self._size -= 1
+
+        self._compact_unused()
+        return result
 
+    def _compact_unused(self):
+        """Builds the table again if most of its rows or directories are not
+        used. Rows of removed paths are used again, but directories are never
+        removed."""
 
-# Watchers.
+        live = self._size + 1024
+        if len(self._free) > live or len(self._node_parents) > 2 * live:
+            self._compact()
 
-class Item:
-    """Represents a file or a directory."""
+    def _compact(self):
+        """Builds the table again without unused rows and directories."""
 
-    def __init__(self, path):
+        x = PathTable()
+        for path in self:
+            x.add_record(path, self.record(path))
+        self.__dict__.update(x.__dict__)
 
-        # Path can be deleted during creating an Item instance.
-        self.path = path
-        try:
-            self.stat = os.stat(path)
-        except (IOError, OSError):
-            self.path = None
 
-        if self.path:
-            if S_ISDIR(self.stat.st_mode):
-                self.is_file = False
-            else:
-                self.is_file = True
+class _TreeWatcher(BaseWatcher):
+    """Base class of Watcher and SimpleWatcher: the first walk of a tree,
+    snapshots, worker processes and the inotify backend. Subclasses set
+    path, is_recursive, backend, _inotify, _pool and _snapshot_file."""
 
-    def is_modified(self):
-        """Returns True if a file/directory was modified."""
+    def __repr__(self):
+        args = self.__class__.__name__, self.path, self.is_recursive
+        return "{}(path={!r}, recursive={!r})".format(*args)
 
-        # Path can be deleted before this method.
-        try:
-            stat = os.stat(self.path)
-        except (IOError, OSError):
-            return True
+    def _initialize(self):
+        """Walks a tree for the first time, see _walk_first(). Returns True
+        if a snapshot was loaded instead."""
+
+        # Watches must be added before walking, changes made during walking
+        # cannot be lost.
+        if self.backend == 'inotify' and self._inotify is None:
+            self._inotify = _inotify_backend(self)
+            if self._inotify is None:
+                self.backend = 'polling'
+
+        # Changes made since a snapshot was saved are found by the first
+        # check, walking is not needed.
+        loaded = bool(self._snapshot_file) \
+            and self._try_load_snapshot(self._snapshot_file)
+        self._snapshot_file = None
+        if loaded or self._walk_first():
+            self.ready.set()
+        return loaded
+
+    def _walk_first(self):
+        """Walks a tree for the first time. Returns False if walking is not
+        finished, the next call of _initialize() continues it."""
+        raise NotImplementedError
+
+    def _try_load_snapshot(self, filename):
+        """Returns False if a snapshot cannot be loaded."""
 
-        if not self.is_file:
-            # st_mode: File mode (permissions)
-            # st_uid: Owner id.
-            # st_gid: Group id.
-            a = self.stat.st_mode, self.stat.st_uid, self.stat.st_gid
-            b = stat.st_mode, stat.st_uid, stat.st_gid
-            if a != b:
-                self.stat = stat
-                return True
+        try:
+            self.load_snapshot(filename)
+        except (IOError, OSError, ValueError):
             return False
+        return True
 
-        # Check if a file is modified.
-        a = self.stat.st_mtime, self.stat.st_size, self.stat.st_mode, \
-            self.stat.st_uid, self.stat.st_gid
-        b = stat.st_mtime, stat.st_size, stat.st_mode, stat.st_uid, stat.st_gid
-        if a != b:
-            self.stat = stat
-            return True
-        return False
+    def _stop_pool(self):
+        """Stops using worker processes."""
+
+        self._pool.shutdown(False)
+        self._pool = None
 
+    def _inotify_changes(self):
+        """Returns a dict with paths reported by inotify, see
+        InotifyBackend.changes(). Returns None if all paths must be checked,
+        also when inotify fails and the watcher falls back to polling."""
 
-class Watcher(BaseWatcher):
-    """Watcher with events."""
+        try:
+            changes = self._inotify.changes()
+            if not self._inotify.is_alive:
+                raise OSError(errno.ENOENT, 'Watched directory is gone')
+
+            # Events were lost, all watches are added again.
+            if changes is None:
+                self._inotify.add_tree(self.path)
+            return changes
 
-    def __init__(self, check_interval, path, recursive=False, filter=None):
-        super().__init__(check_interval)
+        except (IOError, OSError):
+            self._stop_inotify()
+            return None
+
+    def _stop_inotify(self):
+        """Falls back to polling."""
+
+        self._inotify.close()
+        self._inotify = None
+        self.backend = 'polling'
+
+
+class Watcher(_TreeWatcher):
+    """Watcher with events.
+
+    Argument backend sets how changes are found: 'polling' walks the whole
+    tree during each check, 'inotify' (Linux only) checks only paths reported
+    by the kernel. Watcher falls back to polling if inotify is not available
+    or its limits are reached, attribute backend shows which one is used.
+
+    In incremental mode a polling watcher keeps listings of directories and
+    lists again only directories with a changed mtime. Other paths are still
+    stat'ed to find modified ones.
+
+    Lazy watcher does not walk a tree in a constructor, the first check does
+    it (in the check thread if the watcher is started) and reports nothing.
+    Use ready event to wait for it.
+
+    Argument filter is a callable that returns False for ignored paths or
+    PRUNE for ignored directories that should not be entered, see Filter.
+
+    Argument workers sets a number of threads that read directories during
+    walking. Useful on network file systems where each stat call waits for
+    a server.
+
+    Argument processes sets a number of worker processes that scan each
+    directory inside a watched one in recursive mode, see ProcessPool.
+
+    Events run in the check thread, or in threads of a dispatcher if it is
+    given, see Dispatcher.
+
+    Arguments policy, jitter and scheduler set how checks are scheduled, see
+    BaseWatcher.
+
+    Argument debounce (in seconds) delays events of a path until it is not
+    changed for that time. Events of one path are merged meanwhile, for
+    example created and modified is created, created and deleted is nothing.
+    Events of a path changed all the time are delivered at most debounce
+    seconds (or an interval, if it is longer) after the first one.
+
+    If moves is True, a path deleted and created again with the same inode
+    during one check is reported by on_moved(src, dst) event. A moved
+    directory is one event, paths inside it have no events. When walking is
+    split between checks (see budget and slices), created and deleted paths
+    are reported when walking ends, so both halves of a move are paired.
+
+    Argument budget limits stat calls of walking to a number per second, or
+    it is a TokenBucket shared with other watchers, see also Manager. When
+    a budget is used up, a check ends and the next one continues walking,
+    events of paths are run as they are found and deleted paths are found
+    at the end of walking. Attribute lag shows how long walking takes. The
+    first walk is split the same way (ready is set when it ends), paths
+    reported by inotify are left to the next check. A budget cannot be used
+    with processes.
+
+    Walking can be also split into slices: each check lists at most
+    slice_dirs directories or it walks at most slice_time seconds, but not
+    with processes or inotify. If sweep (in seconds) is set, checks are
+    spread so the whole tree is walked once per sweep, interval is used only
+    until the size of a tree is known.
+
+    If hashing is True, files are also compared by their content, so changes
+    that keep mtime and size (for example made by rsync -t) are found. Only
+    files with a changed stat (including ctime and inode) or racily clean
+    ones are read, see HashCache. Files are hashed by the first walk and
+    when a snapshot is loaded. Hashing cannot be used with processes.
+    """
+
+    # Snapshot records: mode, uid, gid, mtime in ns, size, device and inode.
+    SNAPSHOT_KIND = b'W'
+    SNAPSHOT_RECORD = 'IIIqQQQ'
+
+    def __init__(self, check_interval, path, recursive=False, filter=None,
+                 backend='polling', incremental=False, snapshot=None,
+                 lazy=False, workers=None, processes=None, dispatcher=None,
+                 debounce=None, moves=False, budget=None, slice_dirs=None,
+                 slice_time=None, sweep=None, hashing=False,
+                 policy='fixed-delay', jitter=0.1, scheduler=None):
+        super().__init__(check_interval, policy, jitter, scheduler)
+
+        if slice_dirs is not None and slice_dirs < 1:
+            raise ValueError('Slice must have at least one directory')
+        if slice_time is not None and slice_time <= 0:
+            raise ValueError('Slice time must be positive')
+        if sweep is not None and sweep <= 0:
+            raise ValueError('Sweep must be positive')
+        if budget is not None and processes:
+            raise ValueError('Budget cannot be used with processes')
+        if hashing and processes:
+            raise ValueError('Hashing cannot be used with processes')
+        if (slice_dirs is not None or slice_time is not None) \
+                and (processes or backend == 'inotify'):
+            raise ValueError('Slices cannot be used with processes or inotify')
 
         # Path must be always absolute!
         self.path = os.path.abspath(path)
         self.is_recursive = recursive
 
+        # Directory path -> its last listing, used in incremental mode.
+        self.listings = {} if incremental else None
+        self.executor = _executor(self, workers)
+        self._pool = _process_pool(self, processes)
+        # Paths in the watched directory found by the last check of
+        # processes, None if not known.
+        self._top = None
+
         # Callable that checks ignored paths.
-        self.filter = filter
+        self.filter = filter.bind(self.path) if isinstance(filter, Filter) \
+            else filter
+        # Worker processes filter paths themselves if the filter can be sent
+        # to them.
+        self._pool_filter = self.filter if self._pool is not None \
+            and filter is not None and _picklable(filter) else None
         self._events = {}
+        self.dispatcher = dispatcher
+
+        self.debounce = debounce
+        # Path -> (time of the first and the last event, list of merged
+        # events), ordered by the last event.
+        self._pending = OrderedDict()
+        # ChangeSet filled by events during a check.
+        self._batch = None
+
+        self.moves = moves
+        # Created and deleted events of a check or of unfinished walking,
+        # see _dispatch_moves().
+        self._moves = None
+
+        self.backend = _check_backend(backend)
+        self._inotify = None
+
+        # Watched paths, see PathTable.
+        self.watched_paths = PathTable()
+        # Digests of watched files, see hashing argument.
+        self.hashes = HashCache() if hashing else None
+
+        # Token buckets charged by walking, see budget argument.
+        self.budgets = []
+        if budget is not None:
+            self.budgets.append(budget if isinstance(budget, TokenBucket)
+                                else TokenBucket(budget))
+        self._counter = _CheckCounter(self)
+        # Walking continued by the next check and time when it started.
+        self._walking = None
+        self._walk_started = None
+
+        self.slice_dirs = slice_dirs
+        self.slice_time = slice_time
+        self.sweep = sweep
+        # Directories entered by the last slice, by unfinished walking and by
+        # the last finished walking (None if not known).
+        self._slice_dirs = 0
+        self._walk_dirs = 0
+        self._tree_dirs = None
+
+        self._snapshot_file = snapshot
+        if not lazy:
+            self._initialize()
+
+    def _walk_first(self):
+        """Walking stops when a budget is used up, see _TreeWatcher."""
+
+        if self._walking is None:
+            if self._pool is not None \
+                    and self._check_shards(events=False) is not None:
+                return True
+            self._walking = self._walk()
+            self._walk_started = monotonic()
+
+        walking, self._walking = self._walking, None
+        for x in walking:
+            if x is not None:
+                self.watched_paths.add(*x)
+                self._seed_hash(*x)
+            if any(i.available() <= 0 for i in self.budgets):
+                self._walking = walking
+                return False
 
-        # List of watched files, key is a file path, value is an Item instance.
-        self.watched_paths = {}
+        self._walk_started = None
+        return True
 
-        for path in self._walk():
-            self.watched_paths[path] = Item(path)
+    def _walk(self):
+        """Yields watched paths (already filtered) and their stats."""
+        return walk(self.path, self.is_recursive, self.filter, self.listings,
+                    self.executor, self._counter,
+                    on_directory=self._counter.directory, pauses=True)
 
-    def __repr__(self):
-        args = self.__class__.__name__, self.path, self.is_recursive
-        return "{}(path={!r}, recursive={!r})".format(*args)
+    @property
+    def lag(self):
+        """Time (in seconds) since unfinished walking started, or 0."""
 
-    def _walk(self):
-        """Yields watched paths (already filtered)."""
+        if self._walking is None:
+            return 0
+        return monotonic() - self._walk_started
 
-        for path, dirs, files in os.walk(self.path):
-            for i in dirs + files:
-                p = os.path.join(path, i)
-                if self.filter and not self.filter(p):
-                    continue
-                yield p
-            if not self.is_recursive:
-                break
+    def _is_slice_over(self, started, between_dirs):
+        """Returns True if walking should continue in the next check, see
+        slice and budget arguments. Slices end only between directories, so
+        changes of one directory are found by one check."""
+
+        if between_dirs:
+            if self.slice_dirs is not None \
+                    and self._slice_dirs >= self.slice_dirs:
+                return True
+            if self.slice_time is not None \
+                    and monotonic() - started >= self.slice_time:
+                return True
+        return any(i.available() <= 0 for i in self.budgets)
+
+    def save_snapshot(self, filename):
+        """Saves watched paths to a file, see load_snapshot()."""
+
+        x = self.watched_paths
+        _save_snapshot(filename, self.SNAPSHOT_KIND, self.path,
+                       self.SNAPSHOT_RECORD,
+                       ((path, x.record(path)) for path in x))
+
+    def load_snapshot(self, filename):
+        """Loads watched paths from a file saved by save_snapshot(). Changes
+        made since saving are reported by the next check().
+
+        Raises ValueError if a file is not a snapshot of this watcher path."""
+
+        items = _load_snapshot(filename, self.SNAPSHOT_KIND, self.path,
+                               self.SNAPSHOT_RECORD)
+        self.watched_paths = PathTable()
+        self._walking = None
+        for path, values in items:
+            self.watched_paths.add_record(path, values)
+
+        # Changes made after loading are compared with contents of files now.
+        if self.hashes is not None:
+            self.hashes = HashCache()
+            for path in self.watched_paths:
+                try:
+                    self._seed_hash(path, os.stat(path))
+                except (IOError, OSError):
+                    pass
+        # Inotify has not seen changes made before loading.
+        if self._inotify is not None:
+            self._inotify.overflow()
+
+    def _seed_hash(self, path, stat):
+        """Hashes a watched file if hashing is used, see hashing argument."""
+
+        if self.hashes is not None and not S_ISDIR(stat.st_mode):
+            self.hashes.update(path, stat)
 
     def check(self):
         """Detects changes in a file system. Returns True if something changed."""
+        return self._measure(self._collect, self._check)[0]
+
+    def diff(self):
+        """Detects changes like check(). Returns a ChangeSet with items of
+        events run by this call."""
+        return self._measure(self._collect, self._check)[1]
+
+    def _collect(self, function):
+        """Runs function() and collects items of events run meanwhile. Runs
+        on_batch event with them. Returns a result of function() and
+        a ChangeSet."""
+
+        self._batch = batch = ChangeSet()
+        if self.moves and self._moves is None:
+            self._moves = []
+        try:
+            result = function()
+            # Halves of moves are kept until walking ends.
+            if self._moves and self._walking is None:
+                self._dispatch_moves()
+            if self._pending:
+                self._deliver_pending()
+        finally:
+            self._batch = None
+            if self._walking is None:
+                self._moves = None
+
+        if batch:
+            if self.dispatcher is None:
+                self.on_batch(batch)
+            else:
+                self.dispatcher.put(batch, self.on_batch, (batch,))
+        return result, batch
+
+    def _check(self):
+
+        # Paths found by the first walk of a lazy watcher are not created.
+        if not self.ready.is_set() and not self._initialize():
+            return False
+
+        if self._inotify is not None:
+            result = self._check_inotify()
+            if result is not None:
+                return result
+
+        if self._pool is not None:
+            result = self._check_shards()
+            if result is not None:
+                return result
 
         result = False
-        stack = {}
+        deleted = []
+
+        # Paths not found by walking are deleted.
+        walking, self._walking = self._walking, None
+        if walking is None:
+            self.watched_paths.mark()
+            walking = self._walk()
+            self._walk_started = monotonic()
+            self._walk_dirs = 0
+
+        sliced = self.budgets or self.slice_dirs is not None \
+            or self.slice_time is not None
+        started = monotonic()
+        self._slice_dirs = 0
+        try:
+            for x in walking:
+                # None is yielded between directories, see walk().
+                if x is not None and self._merge_path(*x, deleted):
+                    result = True
+                # Walking continues in the next check.
+                if sliced and self._is_slice_over(started, x is None):
+                    self._walking = walking
+                    self._stats.add(incomplete=1)
+                    break
+        finally:
+            self._walk_dirs += self._slice_dirs
+            if self._walking is None:
+                self._tree_dirs = self._walk_dirs
+                deleted.extend(self.watched_paths.sweep())
+
+        for item in deleted:
+            self._dispatch('on_deleted', item)
+            result = True
+        return result
+
+    def _check_shards(self, events=True):
+        """Checks paths using worker processes, paths in the watched
+        directory are checked by this process. Returns None if processes
+        cannot be used anymore."""
+
+        entries = [(path, stat, is_dir and not self._is_pruned(path))
+                   for path, stat, is_dir in
+                   _read_directory(self.path, None, True, None,
+                                   self._counter) or []]
+        try:
+            results = list(self._pool.scan(self.path, entries,
+                                           self.listings is not None,
+                                           self._pool_filter))
+        except _POOL_ERRORS:
+            self._stop_pool()
+            return None
+
+        if self._stats is not None:
+            for changed, deleted, stats in results:
+                self._stats.update(stats)
+
+        # The first walk.
+        if not events:
+            for path, stat, is_dir in entries:
+                if self.filter is None or self.filter(path):
+                    self.watched_paths.add(path, stat)
+            for path, stat in itertools.chain(
+                    *(changed for changed, deleted, stats in results)):
+                if self._is_accepted(path):
+                    self.watched_paths.add(path, stat)
+            self._top = {i[0] for i in entries}
+            return False
 
-        for path in self._walk():
-            if self._path_changed(path, stack):
+        result = False
+        deleted = []
+
+        if self._top is None:
+            self._top = {i for i in self.watched_paths
+                         if os.path.dirname(i) == self.path}
+        top = {i[0] for i in entries}
+        paths = [i for i in self._top if i not in top]
+        self._top = top
+
+        for path, stat, is_dir in entries:
+            if (self.filter is None or self.filter(path)) \
+                    and self._merge_path(path, stat, deleted):
                 result = True
 
+        for changed, x, stats in results:
+            for path, stat in changed:
+                if self._is_accepted(path) \
+                        and self._merge_path(path, stat, deleted):
+                    result = True
+            paths.extend(x)
+
         # Deleted paths.
-        if self.watched_paths:
-            for path in self.watched_paths.values():
-                self.on_deleted(path)
-                result = True
+        for path in paths:
+            if path in self.watched_paths:
+                deleted.append(self.watched_paths.pop(path))
+        for item in deleted:
+            self._dispatch('on_deleted', item)
+            result = True
 
-        self.watched_paths = stack
         return result
 
-    def _path_changed(self, path, stack):
-        """Checks if a path was modified or created."""
+    def _is_pruned(self, path):
+        return self.filter is not None and self.filter(path) is PRUNE
 
-        # File exists and could be modified.
-        if path in self.watched_paths:
-            if self.watched_paths[path].is_file == os.path.isfile(path):
+    def _is_accepted(self, path):
+        """Returns True if a path reported by a worker process is not ignored
+        by a filter."""
+
+        if self.filter is None or self._pool_filter is not None:
+            return True
+        if not self.filter(path):
+            return False
 
-                x = self.watched_paths.pop(path)
-                stack[path] = x
+        # Worker processes without the filter do not prune directories.
+        parent = os.path.dirname(path)
+        while len(parent) > len(self.path):
+            if self.filter(parent) is PRUNE:
+                return False
+            parent = os.path.dirname(parent)
+        return True
 
-                if x.is_modified():
-                    self.on_modified(x)
-                    return True
+    def _merge_path(self, path, stat, deleted):
+        """Checks if a path was modified or created. Items replaced by
+        a different type are added to deleted list. Returns True if a path
+        was modified or created."""
+
+        modified = self.watched_paths.compare(path, stat)
+        if modified is not None:
+            hashes = None if S_ISDIR(stat.st_mode) else self.hashes
+            if modified:
+                if hashes is not None:
+                    hashes.update(path, stat)
+            elif hashes is None or not hashes.is_modified(path, stat):
                 return False
+            self._dispatch('on_modified', Item(path, stat))
+            return True
 
-        # Path was created.
-        x = Item(path)
-        if x.path:
-            stack[path] = x
-            self.on_created(x)
+        # Path was created or replaced.
+        if path in self.watched_paths:
+            deleted.append(self.watched_paths[path])
+        self.watched_paths.add(path, stat)
+        if self.hashes is not None and not S_ISDIR(stat.st_mode):
+            self.hashes.update(path, stat)
+        self._dispatch('on_created', Item(path, stat))
         return True
 
+    def _check_inotify(self):
+        """Checks paths reported by inotify. Returns None if all paths must be
+        checked using polling."""
+
+        changes = self._inotify_changes()
+        if changes is None:
+            return None
+
+        try:
+            result = False
+            # Parents are checked before their children.
+            paths = sorted(changes)
+            for k, path in enumerate(paths):
+                if self._check_path(path, changes[path]):
+                    result = True
+                # Other paths are checked by the next check.
+                if k + 1 < len(paths) \
+                        and any(i.available() <= 0 for i in self.budgets):
+                    self._inotify.defer({i: changes[i] for i in paths[k + 1:]})
+                    self._stats.add(incomplete=1)
+                    break
+            return result
+
+        # Falls back to polling.
+        except (IOError, OSError):
+            self._stop_inotify()
+            return None
+
+    def _check_path(self, path, structural=False):
+        """Checks a single path reported by inotify, the same way as check()
+        does. Argument structural is True if paths inside could change too."""
+
+        try:
+            stat = os.stat(path)
+        except (IOError, OSError):
+            stat = None
+        self._counter.add(paths=stat is not None, stat_calls=1)
+
+        deleted = []
+        if stat is not None and (self.filter is None or self.filter(path)):
+            result = self._merge_path(path, stat, deleted)
+        else:
+            result = path in self.watched_paths
+            if result:
+                deleted.append(self.watched_paths.pop(path))
+
+        # Path deleted or replaced by a different type.
+        for item in deleted:
+            self._dispatch('on_deleted', item)
+
+        if not self.is_recursive or not structural:
+            return result
+
+        # Directory was created, deleted or moved.
+        was_watched, paths = self._inotify.rewatch(path)
+        if not was_watched and not paths:
+            return result
+
+        for i in paths:
+            if self._check_path(i):
+                result = True
+
+        paths = set(paths)
+        for i in self.watched_paths.under(path):
+            if i not in paths:
+                self._dispatch('on_deleted', self.watched_paths.pop(i))
+                result = True
+
+        return result
+
+    def _sweep_interval(self):
+        """Returns time until the next check, so the whole tree is walked
+        once per sweep seconds."""
+
+        if self._walk_started is None:
+            return self.interval
+        left = max(0, self._walk_started + self.sweep - monotonic())
+        if self._walking is None:
+            return left
+        if self._tree_dirs is None:
+            return min(self.interval, left)
+
+        # Next slices are expected to list as many directories as the last
+        # one.
+        remaining = max(1, self._tree_dirs - self._walk_dirs)
+        return left * min(1, max(1, self._slice_dirs) / remaining)
+
+    def _next_interval(self):
+
+        interval = self.interval
+        if self.sweep is not None:
+            interval = self._sweep_interval()
+
+        # Unfinished walking continues when budgets are refilled, or later if
+        # it is spread over a sweep.
+        if self._walking is not None and self.budgets:
+            delay = max(i.delay() for i in self.budgets)
+            interval = min(interval, delay) if self.sweep is None \
+                else max(interval, delay)
+        # Debounced events are delivered on time.
+        if self._pending:
+            due = min(self._due_time(*i) for i in self._pending.values())
+            return max(0, min(interval, due - monotonic()))
+        return interval
+
     # Events.
+
+    def _dispatch(self, name, item):
+        """Runs an event method or delays it, see debounce argument."""
+
+        if self.hashes is not None and name == 'on_deleted':
+            self.hashes.discard(item.path)
+
+        # Deleted and created paths could be moved ones.
+        if self._moves is not None and name != 'on_modified':
+            self._moves.append((name, item))
+            return
+
+        if not self.debounce:
+            self._deliver(name, item)
+            return
+
+        now = monotonic()
+        first, last, events = self._pending.pop(item.path, (now, now, []))
+        _merge_event(events, name, item)
+        if events:
+            self._pending[item.path] = first, now, events
+
+    def _dispatch_moves(self):
+        """Pairs deleted and created paths of the last check (or walking) with
+        the same inode into on_moved events. Directory moves are reported once, not
+        for each path inside."""
+
+        events, self._moves = self._moves, None
+        deleted = {item.inode: item for name, item in events
+                   if name == 'on_deleted' and item.inode[1]}
+
+        # Source path -> created item.
+        moved = {}
+        for name, item in events:
+            if name == 'on_created':
+                x = deleted.get(item.inode)
+                if x is not None and _same_file(x, item):
+                    moved[x.path] = item
+                    del deleted[item.inode]
+        created = {i.path for i in moved.values()}
+
+        for name, item in events:
+            if name == 'on_created' and item.path in created:
+                continue
+            if name == 'on_deleted' and item.path in moved:
+                dst = moved[item.path]
+                # Covered by a move of its parent.
+                parent = moved.get(os.path.dirname(item.path))
+                if parent is None or parent.path != os.path.dirname(dst.path) \
+                        or os.path.basename(item.path) != \
+                        os.path.basename(dst.path):
+                    self._deliver_move(item, dst)
+                continue
+            self._dispatch(name, item)
+
+    def _deliver_move(self, src, dst):
+        """Runs on_moved event. Delayed events of moved paths are delivered
+        before it."""
+
+        if self._pending:
+            prefix = _prefix(src.path)
+            for path in [i for i in self._pending
+                         if i == src.path or i.startswith(prefix)]:
+                for name, item in self._pending.pop(path)[2]:
+                    self._deliver(name, item)
+        self._deliver('on_moved', src, dst)
+
+    def _due_time(self, first, last, events):
+        """Returns when debounced events of a path changed first and last at
+        given times are delivered."""
+        return min(last + self.debounce,
+                   first + max(self.debounce, self.interval))
+
+    def _deliver_pending(self):
+        """Delivers debounced events of paths not changed for debounce
+        seconds, or changed for too long."""
+
+        now = monotonic()
+        for path in [path for path, x in self._pending.items()
+                     if self._due_time(*x) <= now]:
+            for name, item in self._pending.pop(path)[2]:
+                self._deliver(name, item)
+
+    def flush(self):
+        """Delivers all debounced events now. Returns a ChangeSet with their
+        items."""
+        return self._collect(self._flush)[1]
+
+    def _flush(self):
+
+        pending, self._pending = self._pending, OrderedDict()
+        for first, last, events in pending.values():
+            for name, item in events:
+                self._deliver(name, item)
+
+    def _deliver(self, name, *items):
+        """Runs an event method, using a dispatcher if it is set. Events of
+        one path can be coalesced by the dispatcher."""
+
+        if self._batch is not None:
+            getattr(self._batch, name[3:]).append(
+                items[0] if len(items) == 1 else items)
+        if self._stats is not None:
+            self._stats.events += 1
+
+        if self.dispatcher is None:
+            getattr(self, name)(*items)
+        else:
+            self.dispatcher.put_event(self, name, *items)
+
     # TODO: Is this events system useful? I mean calling  events methods like this:
     #       Watcher.on_created(foo)
 
-    def run_event(self, name):
+    def run_event(self, name, *items):
         if name in self._events:
             event = self._events[name]
-            event.callable(*event.args, **event.kwargs)
+            event.callable(*(items + event.args), **event.kwargs)
 
     def _add_event(self, name, callable, args, kwargs):
         Event = namedtuple('Event', 'callable args kwargs')
@@ -245,101 +3134,232 @@ class Watcher(BaseWatcher):
         if callable(item):
             self._add_event('on_created', item, args, kwargs)
         else:
-            self.run_event('on_created')
+            self.run_event('on_created', item)
 
     def on_modified(self, item, *args, **kwargs):
         if callable(item):
             self._add_event('on_modified', item, args, kwargs)
         else:
-            self.run_event('on_modified')
+            self.run_event('on_modified', item)
 
     def on_deleted(self, item, *args, **kwargs):
         if callable(item):
             self._add_event('on_deleted', item, args, kwargs)
         else:
-            self.run_event('on_deleted')
+            self.run_event('on_deleted', item)
+
+    def on_moved(self, src, dst=None, *args, **kwargs):
+        if callable(src):
+            args = args if dst is None else (dst,) + args
+            self._add_event('on_moved', src, args, kwargs)
+        else:
+            self.run_event('on_moved', src, dst)
+
+    def on_batch(self, changes, *args, **kwargs):
+        if callable(changes):
+            self._add_event('on_batch', changes, args, kwargs)
+        else:
+            self.run_event('on_batch', changes)
 
 
-class SimpleWatcher(BaseWatcher):
-    """A Watcher that runs callable when file system has changed."""
+class SimpleWatcher(_TreeWatcher):
+    """A Watcher that runs callable when file system has changed.
+
+    Attribute snapshot is a dict with a digest of each directory, see
+    digests(). Other arguments work the same as in Watcher, but a filter
+    used together with processes must be picklable.
+    """
+
+    # Snapshot records: digest of a directory.
+    SNAPSHOT_KIND = b'S'
+    SNAPSHOT_RECORD = '20s'
 
     def __init__(self, interval, path, target, args=(), kwargs=None,
-                 recursive=False, filter=None):
-        super().__init__(interval)
+                 recursive=False, filter=None, backend='polling',
+                 snapshot=None, lazy=False, workers=None, processes=None,
+                 dispatcher=None, policy='fixed-delay', jitter=0.1,
+                 scheduler=None):
+        super().__init__(interval, policy, jitter, scheduler)
 
         self.path = os.path.abspath(path)
         self.is_recursive = recursive
-        self.filter = filter
+        self.filter = filter.bind(self.path) if isinstance(filter, Filter) \
+            else filter
+        self.executor = _executor(self, workers)
+
+        # Worker processes compute digests, so they need a filter.
+        if processes and filter is not None and not _picklable(filter):
+            raise ValueError('Filter used by processes must be picklable')
+        self._pool = _process_pool(self, processes)
 
         self.target = target
         self.args = args
         self.kwargs = {} if not kwargs else kwargs
+        self.dispatcher = dispatcher
 
-        self.snapshot = self._get_snapshot()
+        self.backend = _check_backend(backend)
+        self._inotify = None
+        self.snapshot = None
+        # Directory path -> quick hash of its records and its digest, see
+        # digests().
+        self._digests = {}
 
-    def __repr__(self):
-        args = self.__class__.__name__, self.path, self.is_recursive
-        return "{}(path={!r}, recursive={!r})".format(*args)
+        self._snapshot_file = snapshot
+        if not lazy:
+            self._initialize()
 
-    def _filtered_paths(self, root, paths):
-        """Yields filtered paths using self.filter and skips deleted ones."""
+    def _walk_first(self):
+        """See _TreeWatcher."""
 
-        for i in paths:
-            if self.filter and not self.filter(os.path.join(root, i)):
-                continue
+        self.snapshot = self._get_snapshot()
+        return True
+
+    def _get_snapshot(self):
+        """Returns dict with digests of directories in self.path location,
+        see digests()."""
 
-            path = os.path.join(root, i)
+        if self._pool is not None:
             try:
-                stats = os.stat(path)
-            # A path could be deleted during execution of this method.
-            except (IOError, OSError):
-                pass
-            else:
-                yield path, stats
+                return self._pool.digests(self.path, self.filter, self._stats)
+            except _POOL_ERRORS:
+                self._stop_pool()
 
-    def _get_snapshot(self):
-        """Returns set with all paths in self.path location."""
+        return digests(self.path, self.is_recursive, self.filter,
+                       self.executor, self._stats, self._digests)
+
+    def save_snapshot(self, filename):
+        """Saves digests of directories to a file, see load_snapshot()."""
 
-        snapshot = set()
+        _save_snapshot(filename, self.SNAPSHOT_KIND, self.path,
+                       self.SNAPSHOT_RECORD,
+                       [(path, (x,)) for path, x in self.snapshot.items()])
 
-        for path, dirs, files in os.walk(self.path):
+    def load_snapshot(self, filename):
+        """Loads digests of directories from a file saved by save_snapshot().
+        The next check() runs a target if something changed since saving.
 
-            # Files.
-            for p, stats in self._filtered_paths(path, dirs):
-                snapshot.add((
-                    p, stats.st_mode, stats.st_uid, stats.st_gid
-                ))
+        Raises ValueError if a file is not a snapshot of this watcher path."""
 
-            # Directories.
-            for p, stats in self._filtered_paths(path, files):
-                snapshot.add((
-                    p,
-                    stats.st_mode, stats.st_uid, stats.st_gid,
-                    stats.st_mtime if PYTHON32 else stats.st_mtime_ns,
-                    stats.st_size
-                ))
+        items = _load_snapshot(filename, self.SNAPSHOT_KIND, self.path,
+                               self.SNAPSHOT_RECORD)
+        self.snapshot = {path: values[0] for path, values in items}
+        # Inotify has not seen changes made before loading.
+        if self._inotify is not None:
+            self._inotify.overflow()
 
-            if not self.is_recursive:
-                break
+    def _rewatch(self, changes):
+        """Updates watches of paths reported by inotify. Returns changes or
+        None if inotify fails and the watcher falls back to polling."""
+
+        if not self.is_recursive:
+            return changes
+        try:
+            for path, structural in changes.items():
+                if structural:
+                    self._inotify.rewatch(path)
+        except (IOError, OSError):
+            self._stop_inotify()
+            return None
+        return changes
+
+    def _update_snapshot(self, changes):
+        """Returns a snapshot with digests of directories reported by inotify
+        (and their parents) computed again, other digests are reused."""
+
+        snapshot = dict(self.snapshot)
+        dirty = set()
+        for path in changes:
+            if changes[path] and self.is_recursive:
+                # A list of directories inside could change.
+                prefix = _prefix(path)
+                for i in [i for i in snapshot if i.startswith(prefix)]:
+                    del snapshot[i]
+                snapshot.pop(path, None)
+                if os.path.isdir(path) and not os.path.islink(path) and (
+                        self.filter is None or self.filter(path) is not PRUNE):
+                    snapshot.update(digests(path, True, self.filter,
+                                            self.executor, self._stats))
+                    dirty.add(path)
+            dirty.add(path if path == self.path else os.path.dirname(path))
+
+        # The deepest directories first, their digests are parts of digests of
+        # their parents.
+        heap = [(-i.count(os.sep), i) for i in dirty]
+        heapq.heapify(heap)
+        while heap:
+            depth, path = heapq.heappop(heap)
+            if path not in dirty:
+                continue
+            dirty.discard(path)
+
+            records = []
+            entries = _read_directory(path, None, self.is_recursive, None,
+                                      self._stats) or ()
+            for p, stat, is_dir in entries:
+                x = True if self.filter is None else self.filter(p)
+                name = os.path.basename(p)
+                if x:
+                    records.append(_record(name, stat))
+                if is_dir and x is not PRUNE and p in snapshot:
+                    records.append((name, 1, snapshot[p]))
+
+            old = snapshot.get(path)
+            # Directories without records have no digest, see digests().
+            if records or path == self.path:
+                snapshot[path] = _digest(records)
+            else:
+                snapshot.pop(path, None)
+            if snapshot.get(path) != old and path != self.path:
+                parent = os.path.dirname(path)
+                if parent not in dirty:
+                    dirty.add(parent)
+                    heapq.heappush(heap, (depth + 1, parent))
         return snapshot
 
     def check(self):
         """Detects changes in a file system. Returns True if something changed."""
+        return self._measure(self._check)
+
+    def _check(self):
+
+        # See Watcher.
+        if not self.ready.is_set() and not self._initialize():
+            return False
 
-        s = self._get_snapshot()
+        changes = None
+        if self._inotify is not None:
+            changes = self._inotify_changes()
+            if changes is not None:
+                if not changes:
+                    return False
+                changes = self._rewatch(changes)
+
+        # Only directories reported by inotify are read again.
+        if changes is None:
+            s = self._get_snapshot()
+        else:
+            s = self._update_snapshot(changes)
         if self.snapshot != s:
-            self.target(*self.args, **self.kwargs)
+            self._stats.events += 1
+            if self.dispatcher is None:
+                self.target(*self.args, **self.kwargs)
+            else:
+                self.dispatcher.put(self, self.target, self.args, self.kwargs)
             self.snapshot = s
             return True
         return False
 
 
 class Manager:
-    """Manager, class that gather watcher instances in one place."""
+    """Manager, class that gather watcher instances in one place.
 
-    def __init__(self):
+    Argument budget limits stat calls of all added watchers to a number per
+    second, see Watcher. Attribute budget is a shared TokenBucket."""
+
+    def __init__(self, budget=None):
         self.watchers = set()
         self.watchers_lock = threading.Lock()
+        self.budget = None if budget is None else TokenBucket(budget)
 
     def __repr__(self):
         args = self.__class__.__name__, len(self.watchers)
@@ -347,13 +3367,19 @@ class Manager:
 
     def add(self, watcher):
         """Adds a watcher instance to this manager. Returns False if the manager
-        already has this watcher."""
+        already has this watcher. Raises ValueError if a budget is shared with
+        a watcher that uses processes."""
 
         if not watcher in self.watchers:
+            if self.budget is not None \
+                    and getattr(watcher, '_pool', None) is not None:
+                raise ValueError('Budget cannot be used with processes')
 
             # Adding to set is thread-safe?
             with self.watchers_lock:
                 self.watchers.add(watcher)
+            if self.budget is not None and hasattr(watcher, 'budgets'):
+                watcher.budgets.append(self.budget)
             return True
         return False
 
@@ -367,21 +3393,39 @@ class Manager:
                 self.watchers.remove(watcher)
             except KeyError:
                 raise KeyError('Manager.remove(x): watcher x not in manager')
+        self._remove_budget(watcher)
         return True
 
+    def _remove_budget(self, watcher):
+        if self.budget is not None and self.budget in \
+                getattr(watcher, 'budgets', ()):
+            watcher.budgets.remove(self.budget)
+
     def clear(self):
         """Removes all watchers instances from this manager. Remember that this
         method do not stops them."""
 
         with self.watchers_lock:
-            self.watchers = set()
+            x, self.watchers = self.watchers, set()
+        for i in x:
+            self._remove_budget(i)
 
     def start(self):
-        """Starts all watchers, skips already started ones."""
+        """Starts all watchers, skips already started ones. Watchers with the
+        'jitter' policy start in phases spread evenly over their intervals,
+        so they do not read a disk at the same moment."""
 
         # with self.watchers_lock:
-        for i in self.watchers.copy():
-            if not i.is_alive:
+        x = [i for i in self.watchers.copy() if not i.is_alive]
+        spread = [i for i in x if i.policy == 'jitter']
+        random.shuffle(spread)
+        phases = {i: (k + random.random()) / len(spread)
+                  for k, i in enumerate(spread)}
+
+        for i in x:
+            if i in phases:
+                i.start(i.interval * phases[i])
+            else:
                 i.start()
 
     def stop(self):
@@ -392,6 +3436,20 @@ class Manager:
             if i.is_alive:
                 i.stop()
 
+    def wait(self, timeout=None):
+        """Waits until all watchers are ready, see BaseWatcher.ready. Returns
+        False if a timeout (in seconds) has passed."""
+
+        with self.watchers_lock:
+            x = self.watchers.copy()
+
+        end = None if timeout is None else monotonic() + timeout
+        for i in x:
+            if not i.ready.wait(None if end is None else
+                                max(0, end - monotonic())):
+                return False
+        return True
+
     def check(self):
         """Triggers check in each watcher instance."""
 
@@ -401,3 +3459,354 @@ class Manager:
         # With this lock threads cannot modify self.watcher.
         for i in x:
             i.check()
+
+    def stats(self):
+        """Returns CheckStats with sums of metrics of all watchers."""
+
+        with self.watchers_lock:
+            x = self.watchers.copy()
+
+        result = CheckStats()
+        for i in x:
+            result.update(i.stats())
+        return result
+
+    def percentiles(self, name='wall_time', percents=(50, 90, 99)):
+        """Returns dict percent -> percentile of a CheckStats attribute in
+        recent checks of all watchers, values are None if there are no checks
+        yet."""
+
+        with self.watchers_lock:
+            x = self.watchers.copy()
+
+        values = [getattr(stats, name) for i in x for stats in list(i.history)]
+        return {i: _percentile(values, i) for i in percents}
+
+    def metrics(self):
+        """Returns metrics of all watchers in the OpenMetrics text format,
+        see openmetrics()."""
+
+        with self.watchers_lock:
+            x = self.watchers.copy()
+        return openmetrics(x)
+
+    def serve_metrics(self, port=9100, host='localhost'):
+        """Serves metrics() over HTTP in a background thread. Returns
+        a http.server.HTTPServer, use its shutdown() method to stop it."""
+
+        manager = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                data = manager.metrics().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', OPENMETRICS_TYPE)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+# Exporting metrics.
+
+OPENMETRICS_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# Counters exported for each watcher: name, CheckStats attribute, help.
+_COUNTERS = (
+    ('checks', 'checks', 'Number of checks.'),
+    ('paths_scanned', 'paths', 'Number of paths scanned by checks.'),
+    ('dirs_listed', 'dirs', 'Number of directories listed by checks.'),
+    ('stat_calls', 'stat_calls', 'Number of stat calls made by checks.'),
+    ('errors', 'errors', 'Number of directories that could not be read.'),
+    ('races', 'races', 'Number of paths deleted during checks.'),
+    ('events', 'events', 'Number of events run by checks.'),
+    ('overruns', 'overruns', 'Number of checks longer than an interval.'),
+    ('incomplete', 'incomplete', 'Number of checks stopped by a budget.'),
+    ('cpu_seconds', 'cpu_time', 'CPU time of check threads.'),
+)
+
+
+def _label(value):
+    """Returns a quoted label value."""
+
+    value = value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+    return '"{}"'.format(value)
+
+
+def _tree_size(watcher):
+    """Returns a number of watched paths, or of directories with a digest
+    for a SimpleWatcher, or None if it is not known."""
+
+    x = getattr(watcher, 'watched_paths', None)
+    if x is None:
+        x = getattr(watcher, 'snapshot', None)
+    return None if x is None else len(x)
+
+
+def openmetrics(watchers):
+    """Returns metrics of watchers in the OpenMetrics text format. Each
+    watcher is labeled by its repr() and by its id(), so watchers with the
+    same repr() have different labels: a histogram of check latencies,
+    counters of CheckStats and a gauge with a number of watched paths."""
+
+    watchers = sorted(((repr(i), id(i), i) for i in watchers),
+                      key=lambda x: x[:2])
+    watchers = [('watcher={},id="{:x}"'.format(_label(name), x), watcher)
+                for name, x, watcher in watchers]
+    lines = []
+
+    lines.append('# TYPE watchers_check_seconds histogram')
+    lines.append('# HELP watchers_check_seconds Wall time of checks.')
+    for label, watcher in watchers:
+        totals = watcher.stats()
+        counts = list(watcher.latency)
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',),
+                                itertools.accumulate(counts)):
+            lines.append('watchers_check_seconds_bucket{{{},le="{}"}} '
+                         '{}'.format(label, bound, count))
+        lines.append('watchers_check_seconds_count{{{}}} {}'.format(
+            label, sum(counts)))
+        lines.append('watchers_check_seconds_sum{{{}}} {!r}'.format(
+            label, totals.wall_time))
+
+    totals = [(label, watcher.stats()) for label, watcher in watchers]
+    for name, attribute, help in _COUNTERS:
+        lines.append('# TYPE watchers_{} counter'.format(name))
+        lines.append('# HELP watchers_{} {}'.format(name, help))
+        for label, stats in totals:
+            lines.append('watchers_{}_total{{{}}} {!r}'.format(
+                name, label, getattr(stats, attribute)))
+
+    lines.append('# TYPE watchers_tree_size gauge')
+    lines.append('# HELP watchers_tree_size Number of watched paths.')
+    for label, watcher in watchers:
+        size = _tree_size(watcher)
+        if size is not None:
+            lines.append('watchers_tree_size{{{}}} {}'.format(
+                label, size))
+
+    lines.append('# TYPE watchers_lag_seconds gauge')
+    lines.append('# HELP watchers_lag_seconds Time since unfinished walking '
+                 'started.')
+    for label, watcher in watchers:
+        lag = getattr(watcher, 'lag', None)
+        if lag is not None:
+            lines.append('watchers_lag_seconds{{{}}} {!r}'.format(
+                label, lag))
+
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsWriter(BaseWatcher):
+    """Writes metrics of a manager to a file in the OpenMetrics text format
+    each interval, for example for the textfile collector of a Prometheus
+    node exporter. The file is replaced at once, readers never see a partly
+    written one."""
+
+    def __init__(self, interval, manager, filename):
+        super().__init__(interval)
+        self.manager = manager
+        self.filename = filename
+        self.ready.set()
+
+    def __repr__(self):
+        args = self.__class__.__name__, self.filename
+        return "{}(filename={!r})".format(*args)
+
+    def check(self):
+        """Writes the metrics file. Returns True."""
+
+        temp = self.filename + '.tmp'
+        with open(temp, 'w') as file:
+            file.write(self.manager.metrics())
+        os.replace(temp, self.filename)
+        return True
+
+
+# Asyncio.
+
+class AsyncWatcher:
+    """Checks a watcher in an asyncio event loop instead of a scheduler.
+
+    Checks run in an executor (by default the default executor of the loop),
+    so thousands of watchers share a few threads. Iterating yields a result
+    of each check that found something: a ChangeSet of a Watcher or True for
+    a SimpleWatcher.
+
+        async for changes in AsyncWatcher(watcher):
+            print(changes.created)
+
+    Iterating starts watching, it ends after stop(). A running check is
+    always finished, even if the watching task is cancelled.
+
+    Each check is one call in the executor and it holds an executor thread
+    until the check ends. Use slice_dirs or slice_time of a Watcher to split
+    walking of a huge tree into short checks.
+    """
+
+    def __init__(self, watcher, executor=None, queue=None):
+
+        self.watcher = watcher
+        self.executor = executor
+        # Queue with (watcher, result of a check) tuples, it can be shared by
+        # many watchers, see AsyncManager.
+        self.queue = queue
+        self._task = None
+
+    def __repr__(self):
+        args = self.__class__.__name__, self.watcher
+        return "{}(watcher={!r})".format(*args)
+
+    @property
+    def is_alive(self):
+        return self._task is not None and not self._task.done()
+
+    async def check(self):
+        """Runs one check in the executor. Returns its result, see
+        iterating."""
+
+        check = getattr(self.watcher, 'diff', self.watcher.check)
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, check)
+        try:
+            return await asyncio.shield(future)
+        # Watcher must not lose changes found by the running check.
+        except asyncio.CancelledError:
+            result = await future
+            if result and self.queue is not None:
+                self.queue.put_nowait((self.watcher, result))
+            raise
+
+    def start(self):
+        """Starts watching in a running loop. Returns False if already
+        started."""
+
+        if self.is_alive:
+            return False
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        return True
+
+    async def stop(self):
+        """Stops watching and waits for a running check. Returns False if
+        already stopped."""
+
+        if not self.is_alive:
+            return False
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        return True
+
+    async def _run(self):
+
+        while True:
+            result = await self.check()
+            if result:
+                await self.queue.put((self.watcher, result))
+            await asyncio.sleep(self.watcher._next_interval())
+
+    def __aiter__(self):
+        self.start()
+        return self
+
+    async def __anext__(self):
+        return (await _next_change(self.queue, [self._task]))[1]
+
+
+async def _next_change(queue, tasks):
+    """Returns the next item of a queue or raises StopAsyncIteration if all
+    tasks are done and the queue is empty. Errors of tasks are raised."""
+
+    while True:
+        if not queue.empty():
+            return queue.get_nowait()
+
+        running = [i for i in tasks if i is not None and not i.done()]
+        for i in tasks:
+            if i is not None and i.done() and not i.cancelled() \
+                    and i.exception() is not None:
+                raise i.exception()
+        if not running:
+            raise StopAsyncIteration
+
+        getter = asyncio.ensure_future(queue.get())
+        done, pending = await asyncio.wait(
+            [getter] + running, return_when=asyncio.FIRST_COMPLETED)
+        if getter in done:
+            return getter.result()
+        getter.cancel()
+
+
+class AsyncManager:
+    """Manager of AsyncWatcher instances. Iterating yields (watcher, result
+    of a check) tuples from all watchers."""
+
+    def __init__(self, executor=None):
+
+        self.executor = executor
+        self.watchers = {}
+        self.queue = None
+
+    def __repr__(self):
+        args = self.__class__.__name__, len(self.watchers)
+        return "{}(watchers={!r})".format(*args)
+
+    def add(self, watcher):
+        """Adds a watcher instance, it is started if the manager is already
+        started. Returns False if the manager already has this watcher."""
+
+        if watcher in self.watchers:
+            return False
+        x = AsyncWatcher(watcher, self.executor, self.queue)
+        self.watchers[watcher] = x
+        if self.queue is not None:
+            x.start()
+        return True
+
+    async def remove(self, watcher):
+        """Stops a watcher and removes it from this manager. Raises KeyError
+        if a watcher is not available in the manager."""
+
+        try:
+            x = self.watchers.pop(watcher)
+        except KeyError:
+            raise KeyError('AsyncManager.remove(x): watcher x not in manager')
+        await x.stop()
+        return True
+
+    def start(self):
+        """Starts all watchers in a running loop."""
+
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        for i in list(self.watchers.values()):
+            i.queue = self.queue
+            i.start()
+
+    async def stop(self):
+        """Stops all watchers and waits for their running checks."""
+
+        await asyncio.gather(*[i.stop() for i in list(self.watchers.values())])
+
+    def __aiter__(self):
+        self.start()
+        return self
+
+    async def __anext__(self):
+        return await _next_change(self.queue,
+                                  [i._task for i in self.watchers.values()])